@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+import numpy as np
+import diplib as dip
+from utilities import *
+from instrument import PeakMemory, fix_mmap_threshold
+
+
+STAGES = ['normalize_resize', 'make_grayscale', 'threshold_images',
+          'apply_transformations', 'measure_elements', 'blue_area',
+          'calculate_hog', 'save_images']
+
+FEATURES = ['Perimeter', 'Size',
+            'Circularity', 'Roundness',
+            'StandardDeviation', 'Minimum','Maximum']
+
+
+def synthetic_embryo(size, seed=0):
+    """ Deterministic synthetic image resembling the dataset: a bright
+        elliptic embryo on a dark background, with blue blobs (low red
+        channel) for the gene expression.
+        Input:
+            - size: int for square images or (height, width) tuple
+            - seed: seed of the random generator
+        Returns:
+            - RGB uint16 diplib image
+    """
+    if np.isscalar(size):
+        size = (size, size)
+    h, w = size
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:h, :w]
+    img = np.empty((h, w, 3), np.float32)
+    img[:] = [10000, 11000, 2000]
+    # embryo, darker towards the border
+    cy, cx = h*rng.uniform(0.4, 0.6), w*rng.uniform(0.4, 0.6)
+    ry, rx = h*rng.uniform(0.18, 0.3), w*rng.uniform(0.18, 0.3)
+    r = ((yy-cy)/ry)**2 + ((xx-cx)/rx)**2
+    inside = r < 1
+    img[inside] = [23000, 33000, 29000]
+    img[inside] *= (1 - 0.4*r[inside])[:, None]
+    del r, inside
+    # blue blobs within the embryo
+    for _ in range(rng.integers(1, 4)):
+        by = cy + ry*rng.uniform(-0.5, 0.5)
+        bx = cx + rx*rng.uniform(-0.5, 0.5)
+        blob = ((yy-by)/(ry*rng.uniform(0.1, 0.35)))**2 + \
+               ((xx-bx)/(rx*rng.uniform(0.1, 0.35)))**2 < 1
+        img[blob] = [100, 20000, 30000]
+    del yy, xx
+    sigma = max(h, w)/150
+    img = np.array(dip.Gauss(dip.Image(img), sigmas=[sigma, sigma]))
+    img += rng.normal(0, 600, img.shape).astype(np.float32)
+    return dip.Image(np.clip(img, 0, 65535).astype(np.uint16))
+
+def synthetic_dataset(n_images, size, seed=0):
+    """ List of n_images synthetic embryos
+    """
+    return [synthetic_embryo(size, seed+i) for i in range(n_images)]
+
+def write_synthetic_dataset(images_dir, n_images, size, seed=0):
+    """ Writes a synthetic dataset as tif files, loadable by
+        load_dip_images, to run the scripts without the real data.
+    """
+    save_images(synthetic_dataset(n_images, size, seed), images_dir, "embryo")
+
+
+def stage_inputs(originals, out_dir):
+    """ Stage name -> (function, args) for every benchmarked stage,
+        the inputs being computed once beforehand.
+    """
+    grays = make_grayscale(originals)
+    thresh = threshold_images(grays)
+    transf = apply_transformations(thresh)
+    return {
+        'normalize_resize': (normalize_resize, (originals,)),
+        'make_grayscale': (make_grayscale, (originals,)),
+        'threshold_images': (threshold_images, (grays,)),
+        'apply_transformations': (apply_transformations, (thresh,)),
+        'measure_elements': (measure_elements, (transf, grays, FEATURES)),
+        'blue_area': (blue_area, (originals, FEATURES)),
+        'calculate_hog': (partial(calculate_hog, rgb=False, visualize=True),
+                            (grays,)),
+        'save_images': (save_images, (transf, out_dir, "bench")),
+    }
+
+def time_stage(func, args, repeat=3):
+    """ Best and mean wall time and the peak memory of func(*args), the
+        memory being measured once in a fresh process, see peak_memory
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return {'best_s': min(times), 'mean_s': float(np.mean(times)),
+            'peak_mb': peak_memory(func, args)/1024**2}
+
+def peak_memory(func, args):
+    """ Peak memory in bytes allocated by func(*args), measured in a
+        new process: in this one the stage could reuse heap memory
+        freed by the earlier stages and show no peak.
+    """
+    with ProcessPoolExecutor(max_workers=1,
+                            mp_context=get_context("spawn")) as pool:
+        return pool.submit(_measure_peak, func, pack_images(args)).result()
+
+def _measure_peak(func, args):
+    # every image gets its own mapping, unmapped when it is freed, so
+    # that the RSS follows the allocations of the stage
+    fix_mmap_threshold()
+    args = unpack_images(args)
+    with PeakMemory() as mem:
+        func(*args)
+    return mem.peak
+
+def run_benchmarks(sizes=(256, 512, 1024, 2048, 4096), n_images=2,
+                    repeat=3, stages=STAGES, seed=0):
+    """ Times every stage on synthetic datasets of the given sizes.
+        Returns:
+            - dict with the environment and, per stage and size, the
+                best and mean time in seconds and the peak memory in MB
+    """
+    results = {stage: {} for stage in stages}
+    with tempfile.TemporaryDirectory() as out_dir:
+        for size in sizes:
+            originals = synthetic_dataset(n_images, size, seed)
+            inputs = stage_inputs(originals, out_dir)
+            for stage in stages:
+                func, args = inputs[stage]
+                results[stage][str(size)] = time_stage(func, args, repeat)
+                print("%-22s %5d  %8.3fs  %8.1fMB" % (stage, size,
+                        results[stage][str(size)]['best_s'],
+                        results[stage][str(size)]['peak_mb']))
+            del originals, inputs
+    meta = {'python': platform.python_version(), 'numpy': np.__version__,
+            'diplib': dip.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count(), 'n_images': n_images, 'repeat': repeat,
+            'seed': seed, 'time': time.strftime("%Y-%m-%dT%H:%M:%S")}
+    return {'meta': meta, 'results': results}
+
+def roi_deviation(originals):
+    """ Relative difference of the foreground area segmented by the
+        region of interest grayscale (make_grayscale_roi) to the full
+        frame one, for every image
+    """
+    full = apply_transformations(threshold_images(make_grayscale(originals)))
+    grays, _ = make_grayscale_roi(originals)
+    roi = apply_transformations(threshold_images(grays))
+    return [abs(np.count_nonzero(r) - np.count_nonzero(f)) /
+                max(np.count_nonzero(f), 1)
+            for r, f in zip(roi, full)]
+
+# bound of roi_deviation checked by --check-roi
+ROI_MAX_DEVIATION = 0.1
+
+# absolute changes below these are considered noise
+NOISE_FLOOR = {'best_s': 0.002, 'peak_mb': 1.0}
+
+def compare(old, new, threshold=0.1):
+    """ Compares two benchmark results.
+        Input:
+            - old, new: outputs of run_benchmarks
+            - threshold: relative slowdown (or memory growth) above
+                which a stage is flagged as a regression, provided the
+                absolute change is above NOISE_FLOOR
+        Returns:
+            - list of (stage, size, metric, old, new, ratio, regressed)
+    """
+    rows = []
+    for stage, by_size in new['results'].items():
+        for size, values in by_size.items():
+            old_values = old['results'].get(stage, {}).get(size)
+            if old_values is None:
+                continue
+            for metric in ['best_s', 'peak_mb']:
+                before, after = old_values[metric], values[metric]
+                ratio = after/before if before > 0 else float('inf') if after > 0 else 1.0
+                regressed = ratio > 1 + threshold and \
+                            after - before > NOISE_FLOOR[metric]
+                rows.append((stage, size, metric, before, after, ratio,
+                            regressed))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-stage benchmarks "
+                                    "on synthetic embryo images")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[256, 512, 1024, 2048, 4096])
+    parser.add_argument("--images", type=int, default=2,
+                        help="images per size")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark.json",
+                        help="JSON file where the results are saved")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved results instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change flagged as a regression")
+    parser.add_argument("--check-roi", action="store_true",
+                        help="only check that the region of interest "
+                            "segmentation of --images images of the first "
+                            "size stays within %d%% of the full frame one"
+                            % (100*ROI_MAX_DEVIATION))
+    parser.add_argument("--write-data", metavar="DIR",
+                        help="only write a synthetic dataset of --images "
+                            "images of the first size to DIR")
+    args = parser.parse_args()
+
+    if args.check_roi:
+        deviations = roi_deviation(synthetic_dataset(args.images,
+                                    args.sizes[0], args.seed))
+        for i, deviation in enumerate(deviations):
+            print("image %d: %.2f%% area difference" % (i, 100*deviation))
+        sys.exit(1 if max(deviations) > ROI_MAX_DEVIATION else 0)
+    elif args.write_data:
+        write_synthetic_dataset(args.write_data, args.images, args.sizes[0],
+                                args.seed)
+    elif args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        for stage, size, metric, before, after, ratio, regressed in rows:
+            print("%-22s %5s %-8s %10.3f %10.3f  x%.2f%s" % (stage, size,
+                    metric, before, after, ratio,
+                    "  REGRESSION" if regressed else ""))
+        sys.exit(1 if any(row[-1] for row in rows) else 0)
+    else:
+        results = run_benchmarks(args.sizes, args.images, args.repeat,
+                                args.stages, args.seed)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved", args.output)
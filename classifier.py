@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import pickle
+import socket
+import argparse
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sklearn import svm
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import classification_report
+from feature_store import (FeatureStore, expand_feature_sets, image_features,
+                            PIPELINE_VERSION)
+import diplib as dip
+
+
+# class boundaries used in the notebook: embryo area and percentage of
+# blue area
+THRESHOLDS = {'area': [13650, 17500], 'blue_area_pct': [20, 38]}
+
+# columns giving back a thresholded column: the column, the columns
+# computed from it and the ones it is computed from, dropped from the
+# features of a classifier trained on its threshold labels
+LABEL_SOURCES = {'area': ['area', 'blue_area_pct', 'blue_perimeter_pct'],
+                    'blue_area_pct': ['blue_area_pct', 'blue_area',
+                                        'blue_perimeter_pct']}
+
+
+def threshold_labels(values, thresholds):
+    """ Class of every value, 0 below thresholds[0], 1 up to
+        thresholds[1] and so on
+    """
+    return np.searchsorted(thresholds, values, side="right")
+
+
+class Classifier:
+    """ SVM on a chosen set of feature store columns, with the scaler
+        fitted on the training data.
+
+        Params:
+            - columns: feature store columns (or names of FEATURE_SETS)
+                the classifier uses
+            - params: keyword arguments of svm.SVC
+    """
+
+    def __init__(self, columns=("shape",), **params):
+        self.columns = expand_feature_sets(columns)
+        self.model = make_pipeline(StandardScaler(), svm.SVC(**params))
+        self.version = PIPELINE_VERSION
+
+    def fit(self, X, y):
+        self.model.fit(X, y)
+        return self
+
+    def predict(self, X):
+        """ Classes of the rows of the feature matrix X, None for the
+            rows missing a feature (e.g. no embryo found)
+        """
+        X = np.asarray(X, dtype=np.float64)
+        valid = np.isfinite(X).all(axis=1)
+        if valid.all():
+            return self.model.predict(X)
+        print("Warning: %d of %d rows miss features, not classified" %
+                (len(X) - valid.sum(), len(X)), file=sys.stderr)
+        labels = np.full(len(X), None, dtype=object)
+        if valid.any():
+            labels[valid] = self.model.predict(X[valid]).tolist()
+        return labels
+
+    def matrix(self, rows):
+        """ Feature matrix of rows given as dicts column -> value, e.g.
+            outputs of image_features
+        """
+        return np.vstack([np.hstack([np.ravel(row[name])
+                                        for name in self.columns])
+                            for row in rows])
+
+    def predict_features(self, rows):
+        return self.predict(self.matrix(rows))
+
+    def predict_keys(self, store, keys):
+        """ Classes of rows of a FeatureStore, given by their keys: the
+            fast path, the features being read and not computed
+        """
+        return self.predict(store.matrix(self.columns, keys))
+
+    def predict_images(self, paths, indices=None):
+        """ Classes of image files, their features computed here: every
+            image is segmented and measured first (image_features),
+            which takes seconds per frame, see predict_keys for stored
+            features
+            Input:
+                - paths: paths of the tif images
+                - indices: position of every image in its series, see
+                    threshold_method, 0 if None
+        """
+        if indices is None:
+            indices = [0]*len(paths)
+        rows = [image_features(dip.ImageReadTIFF(path), index)
+                    for path, index in zip(paths, indices)]
+        return self.predict_features(rows)
+
+    def save(self, path):
+        """ Saves the fitted scaler and model with the columns they use
+        """
+        # a dict, so that loading does not depend on the module that
+        # saved the classifier (e.g. __main__)
+        state = {'columns': self.columns, 'model': self.model,
+                    'version': self.version}
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        model = Classifier(state['columns'])
+        model.model = state['model']
+        model.version = state['version']
+        if model.version != PIPELINE_VERSION:
+            print("Warning: %s was trained on features of pipeline version"
+                    " %s, not %s" % (path, model.version, PIPELINE_VERSION),
+                    file=sys.stderr)
+        return model
+
+
+def train(store, columns, labels, test_size=0.2, seed=0, **params):
+    """ Trains a Classifier on the rows of store
+        Input:
+            - store: FeatureStore
+            - columns: columns or feature sets used by the classifier
+            - labels: class of every row of store.read()
+            - test_size: fraction of the rows held out to report the
+                accuracy, 0 to train on every row
+        Returns:
+            - the trained classifier and the classification report
+    """
+    model = Classifier(columns, **params)
+    X = store.matrix(model.columns)
+    labels = np.asarray(labels)
+    # rows missing a feature, NaN by design when no embryo was found
+    # (see image_features), as clustering._valid_chunks
+    valid = np.isfinite(X).all(axis=1)
+    if not valid.all():
+        print("Dropped %d of %d rows missing features" %
+                (len(X) - valid.sum(), len(X)), file=sys.stderr)
+        X, labels = X[valid], labels[valid]
+    report = None
+    if test_size > 0:
+        X_train, X_test, y_train, y_test = train_test_split(
+            X, labels, test_size=test_size, random_state=seed)
+        model.fit(X_train, y_train)
+        report = classification_report(y_test, model.predict(X_test),
+                                        zero_division=0)
+    model.fit(X, labels)
+    return model, report
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """ POST /predict with a JSON body holding "features", a list of
+        dicts column -> value, "keys", content hashes of rows of the
+        served FeatureStore, or "paths", a list of image files (and
+        optionally their "indices"). Paths are segmented before being
+        classified, seconds per frame; features and keys are answered
+        in milliseconds. Answers the classes and the time spent on the
+        request.
+    """
+
+    def do_POST(self):
+        start = time.perf_counter()
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+        try:
+            body = json.loads(self.rfile.read(
+                                int(self.headers.get("Content-Length", 0))))
+            if "paths" in body:
+                labels = self.server.model.predict_images(body["paths"],
+                                                    body.get("indices"))
+            elif "keys" in body:
+                if self.server.store is None:
+                    raise ValueError("no feature store served, see --store")
+                labels = self.server.model.predict_keys(self.server.store,
+                                                        body["keys"])
+            else:
+                labels = self.server.model.predict_features(body["features"])
+        except (ValueError, KeyError, TypeError, RuntimeError) as e:
+            self.send_error(400, str(e))
+            return
+        latency = (time.perf_counter() - start)*1000
+        self._answer({'labels': np.asarray(labels).tolist(),
+                        'latency_ms': latency}, latency)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self.send_error(404)
+            return
+        self._answer({'columns': self.server.model.columns,
+                        'version': self.server.model.version}, 0.0)
+
+    def _answer(self, data, latency):
+        payload = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.send_header("X-Latency-Ms", "%.3f" % latency)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.log_message('"%s" %.1f ms', self.requestline, latency)
+
+    def log_request(self, code="-", size="-"):
+        # successful requests are logged with their latency by _answer
+        pass
+
+    def address_string(self):
+        # unix sockets have no client address
+        return str(self.client_address or "local")
+
+    def log_message(self, format, *args):
+        sys.stderr.write("%s %s\n" % (self.address_string(), format % args))
+
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name, self.server_port = "localhost", 0
+
+def serve(model, host="127.0.0.1", port=8765, unix_socket=None,
+            store=None):
+    """ Answers predict requests with model kept in memory, on a local
+        HTTP port or on a unix socket. Requests are handled by
+        concurrent threads, the stages keeping their scratch images
+        per thread (see MorphologyChain).
+        store is the optional FeatureStore of the "keys" requests, its
+        rows being those present when it was opened.
+    """
+    if unix_socket is not None:
+        server = _UnixHTTPServer(unix_socket, _Handler)
+    else:
+        server = ThreadingHTTPServer((host, port), _Handler)
+    server.model = model
+    server.store = store
+    print("Serving on", unix_socket or "http://%s:%d" % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SVM classification of "
+                                    "the embryos from the feature store")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_train = sub.add_parser("train", help="train and save a classifier")
+    p_train.add_argument("--store", default="features")
+    p_train.add_argument("--features", nargs="+", default=["shape"],
+                        help="feature sets (shape, texture, hog) or columns")
+    labels = p_train.add_mutually_exclusive_group(required=True)
+    labels.add_argument("--labels", default=None,
+                        help="CSV file with filename,label lines")
+    labels.add_argument("--threshold-labels", default=None,
+                        choices=list(THRESHOLDS),
+                        help="debugging only: labels made by thresholding "
+                            "this column as in the notebook; the column and "
+                            "the columns giving it back are dropped from "
+                            "the features, as the classifier would "
+                            "otherwise only recover the threshold")
+    p_train.add_argument("--test-size", type=float, default=0.2)
+    p_train.add_argument("--model", default="model.pkl")
+    p_predict = sub.add_parser("predict", help="classify image files, "
+                                "segmenting them first (seconds per frame)")
+    p_predict.add_argument("paths", nargs="+")
+    p_predict.add_argument("--model", default="model.pkl")
+    p_serve = sub.add_parser("serve", help="serve predictions")
+    p_serve.add_argument("--model", default="model.pkl")
+    p_serve.add_argument("--host", default="127.0.0.1")
+    p_serve.add_argument("--port", type=int, default=8765)
+    p_serve.add_argument("--socket", default=None,
+                        help="listen on this unix socket instead")
+    p_serve.add_argument("--store", default=None,
+                        help="feature store of the requests giving keys")
+    args = parser.parse_args()
+
+    if args.command == "train":
+        store = FeatureStore(args.store)
+        if args.labels is not None:
+            with open(args.labels) as f:
+                by_name = dict(line.strip().split(",")[:2] for line in f
+                                if line.strip())
+            names = [store.names[i] for i, v in enumerate(store.versions)
+                        if v == store.version]
+            labels = [by_name[name] for name in names]
+        else:
+            column = args.threshold_labels
+            labels = threshold_labels(store.read([column])[column],
+                                        THRESHOLDS[column])
+            dropped = [x for x in expand_feature_sets(args.features)
+                        if x in LABEL_SOURCES[column]]
+            args.features = [x for x in expand_feature_sets(args.features)
+                                if x not in dropped]
+            print("Threshold labels of %s, not using %s as features" %
+                    (column, ", ".join(dropped) or "no column"),
+                    file=sys.stderr)
+        model, report = train(store, args.features, labels, args.test_size)
+        if report is not None:
+            print(report)
+        model.save(args.model)
+        print("Saved", args.model)
+    elif args.command == "predict":
+        start = time.perf_counter()
+        model = Classifier.load(args.model)
+        for path, label in zip(args.paths, model.predict_images(args.paths)):
+            print(path, label)
+        print("%.3fs" % (time.perf_counter() - start), file=sys.stderr)
+    else:
+        store = FeatureStore(args.store) if args.store is not None else None
+        serve(Classifier.load(args.model), args.host, args.port, args.socket,
+                store)
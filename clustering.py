@@ -0,0 +1,202 @@
+import os
+import argparse
+import pickle
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import silhouette_score
+from feature_store import FeatureStore, expand_feature_sets
+
+
+class StreamingClusters:
+    """ Mini-batch KMeans over feature store columns, fitted chunk by
+        chunk so that the feature matrix is never held in memory: a
+        first pass fits the scaler, the next ones (epochs) update the
+        clusters.
+
+        Params:
+            - columns: feature store columns or names of FEATURE_SETS
+            - n_clusters: number of clusters, about three mutant classes
+            - seed: seed of the initialisation
+    """
+
+    def __init__(self, columns=("shape",), n_clusters=3, seed=0):
+        self.columns = expand_feature_sets(columns)
+        self.n_clusters = n_clusters
+        self.scaler = StandardScaler()
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed,
+                                        n_init=3)
+
+    def fit(self, store, chunksize=4096, epochs=3):
+        """ Fits the scaler and the clusters on the rows of store
+        """
+        for _, X in _valid_chunks(store, self.columns, chunksize):
+            self.scaler.partial_fit(X)
+        pending = None
+        for _ in range(epochs):
+            for _, X in _valid_chunks(store, self.columns, chunksize):
+                X = self.scaler.transform(X)
+                # the first batch has to hold at least n_clusters rows
+                if pending is not None:
+                    X = np.vstack([pending, X])
+                if len(X) < self.n_clusters:
+                    pending = X
+                    continue
+                pending = None
+                self.kmeans.partial_fit(X)
+        return self
+
+    def predict(self, X):
+        """ Cluster of every row of the feature matrix X
+        """
+        return self.kmeans.predict(self.scaler.transform(X))
+
+    def assign(self, store, chunksize=4096, column="cluster"):
+        """ Writes the cluster of the rows of store that have none yet,
+            e.g. the images added since the last call
+            Returns:
+                - number of rows assigned
+        """
+        done = set()
+        if column in store.columns:
+            values = store.read([column])[column]
+            keys = [store.keys[i] for i, v in enumerate(store.versions)
+                        if v == store.version]
+            done = {key for key, x in zip(keys, values) if not np.isnan(x)}
+        assigned = 0
+        for keys, X in _valid_chunks(store, self.columns, chunksize):
+            new = [i for i, key in enumerate(keys) if key not in done]
+            if not new:
+                continue
+            labels = self.predict(X[new])
+            store.upsert([keys[i] for i in new], {column: labels})
+            assigned += len(new)
+        return assigned
+
+    def quality(self, store, chunksize=4096, sample=5000, seed=0):
+        """ Cluster quality metrics computed in two streaming passes,
+            the first one finding the cluster means
+            Returns:
+                - dict with the inertia, the Calinski-Harabasz and the
+                    Davies-Bouldin indices, the cluster sizes and the
+                    silhouette score of a random sample of rows
+        """
+        rng = np.random.default_rng(seed)
+        k = self.n_clusters
+        centers = self.kmeans.cluster_centers_
+        counts = np.zeros(k)
+        sums = np.zeros_like(centers)
+        reservoir, labels_sample, seen = [], [], 0
+        for _, X in _valid_chunks(store, self.columns, chunksize):
+            X = self.scaler.transform(X)
+            labels = self.kmeans.predict(X)
+            counts += np.bincount(labels, minlength=k)
+            np.add.at(sums, labels, X)
+            # reservoir sample of the rows for the silhouette
+            for x, label in zip(X, labels):
+                seen += 1
+                if len(reservoir) < sample:
+                    reservoir.append(x)
+                    labels_sample.append(label)
+                else:
+                    j = rng.integers(seen)
+                    if j < sample:
+                        reservoir[j] = x
+                        labels_sample[j] = label
+        n = counts.sum()
+        means = sums / np.maximum(counts, 1)[:, None]
+        # distances to the cluster means, and to the centers (inertia)
+        dist = np.zeros(k)
+        sq_dist = np.zeros(k)
+        inertia = 0.0
+        for _, X in _valid_chunks(store, self.columns, chunksize):
+            X = self.scaler.transform(X)
+            labels = self.kmeans.predict(X)
+            d = np.linalg.norm(X - means[labels], axis=1)
+            dist += np.bincount(labels, weights=d, minlength=k)
+            sq_dist += np.bincount(labels, weights=d**2, minlength=k)
+            inertia += np.sum((X - centers[labels])**2)
+        used = counts > 0
+        n_used = used.sum()
+        metrics = {'rows': int(n), 'sizes': counts.astype(int).tolist(),
+                    'inertia': float(inertia)}
+        if 1 < n_used < n:
+            overall = sums.sum(axis=0) / n
+            within = sq_dist.sum()
+            between = np.sum(counts[used] *
+                                np.sum((means[used] - overall)**2, axis=1))
+            metrics['calinski_harabasz'] = float(
+                between / within * (n - n_used) / (n_used - 1))
+            scatter = dist[used] / counts[used]
+            gap = np.linalg.norm(means[used][:, None] - means[used][None],
+                                    axis=2)
+            np.fill_diagonal(gap, np.inf)
+            metrics['davies_bouldin'] = float(np.mean(np.max(
+                (scatter[:, None] + scatter[None]) / gap, axis=1)))
+        if len(set(labels_sample)) > 1:
+            metrics['silhouette_sample'] = float(silhouette_score(
+                np.array(reservoir), np.array(labels_sample)))
+        return metrics
+
+    def save(self, path):
+        state = {'columns': self.columns, 'n_clusters': self.n_clusters,
+                    'scaler': self.scaler, 'kmeans': self.kmeans}
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        model = StreamingClusters(state['columns'], state['n_clusters'])
+        model.scaler = state['scaler']
+        model.kmeans = state['kmeans']
+        return model
+
+
+def _valid_chunks(store, columns, chunksize):
+    """ Chunks of store without the rows missing a feature
+    """
+    for keys, X in store.iter_chunks(columns, chunksize):
+        valid = np.isfinite(X).all(axis=1)
+        if not valid.all():
+            keys = [key for key, v in zip(keys, valid) if v]
+            X = X[valid]
+        if len(X):
+            yield keys, X
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mini-batch clustering of "
+                                    "the embryos of the feature store")
+    parser.add_argument("command", choices=["fit", "assign", "quality"],
+                        help="fit the clusters (and assign every row), "
+                            "assign the new rows or report the quality")
+    parser.add_argument("--store", default="features")
+    parser.add_argument("--features", nargs="+", default=["shape"],
+                        help="feature sets (shape, texture, hog) or columns")
+    parser.add_argument("--clusters", type=int, default=3)
+    parser.add_argument("--chunksize", type=int, default=4096,
+                        help="rows read from the store at a time")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--model", default="clusters.pkl")
+    args = parser.parse_args()
+
+    store = FeatureStore(args.store)
+    if args.command == "fit":
+        model = StreamingClusters(args.features, args.clusters)
+        model.fit(store, args.chunksize, args.epochs)
+        model.save(args.model)
+        print("Saved", args.model)
+        # clusters of the previous model are stale
+        if "cluster" in store.columns:
+            keys = [store.keys[i] for i, v in enumerate(store.versions)
+                        if v == store.version]
+            store.upsert(keys, {"cluster": np.full(len(keys), np.nan)})
+    else:
+        model = StreamingClusters.load(args.model)
+    if args.command in ["fit", "assign"]:
+        print("Assigned %d images" % model.assign(store, args.chunksize))
+    print(model.quality(store, args.chunksize))
@@ -0,0 +1,440 @@
+import os
+import json
+import hashlib
+import argparse
+import numpy as np
+import diplib as dip
+from natsort import natsorted
+from utilities import *
+from generate_images import embryo_gray, blue_resize, blue_gray
+from texture import texture_features
+
+
+# bump when a stage changes its results, so that the stored features
+# are computed again
+PIPELINE_VERSION = "2"
+
+# rows of a new column file, and rows copied at a time when a column
+# file grows
+MIN_CAPACITY = 64
+COPY_ROWS = 4096
+
+FEATURES = ['Perimeter', 'Size', 'Circularity', 'Roundness',
+            'StandardDeviation', 'Minimum', 'Maximum']
+
+# threshold methods of threshold_method, stored as their position in
+# this list in the threshold_method column
+THRESHOLD_METHODS = ["otsu", "triangle"]
+
+# columns of image_features, grouped as in the README
+FEATURE_SETS = {
+    'shape': ['area', 'perimeter', 'circularity', 'roundness', 'std',
+                'blue_objects', 'blue_area', 'blue_perimeter',
+                'blue_area_pct', 'blue_perimeter_pct'],
+    'texture': ['unif_embryo', 'std_embryo', 'unif_blue', 'std_blue',
+                'texture'],
+    'hog': ['hog'],
+}
+
+def expand_feature_sets(sets):
+    """ Store columns of the given feature sets (names of FEATURE_SETS)
+        and columns
+    """
+    columns = []
+    for x in sets:
+        for column in FEATURE_SETS.get(x, [x]):
+            if column not in columns:
+                columns.append(column)
+    return columns
+
+
+class FeatureStore:
+    """ Persistent table of per image features, one row per source
+        image keyed by the hash of its file content. Every column is
+        stored in its own .npy file, so any subset of columns can be
+        read (memory mapped) without parsing the others. The files
+        grow by doubling their capacity and rows are written in place,
+        so adding rows costs time in the rows added, not in the rows
+        stored.
+        Columns are float arrays, with a scalar or a fixed length
+        vector (e.g. a HOG descriptor) per image; rows without a value
+        for a column hold NaN.
+
+        Params:
+            - path: directory of the store
+            - version: pipeline version of the rows written, rows of
+                other versions count as missing
+    """
+
+    def __init__(self, path="features", version=PIPELINE_VERSION):
+        self.path = path
+        self.version = version
+        try:
+            with open(os.path.join(path, "index.json")) as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            index = {'keys': [], 'names': [], 'versions': [], 'columns': {}}
+        self.keys = index['keys']
+        self.names = index['names']
+        self.versions = index['versions']
+        # column name -> [dtype, shape of a value]
+        self.columns = index['columns']
+        # rows changed since index.json was written
+        self._journal = 0
+        try:
+            with open(os.path.join(path, "index.journal")) as f:
+                for line in f:
+                    self._replay(json.loads(line))
+        except FileNotFoundError:
+            pass
+        self._rows = {key: i for i, key in enumerate(self.keys)}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        """ True if key has a row of the current version
+        """
+        row = self._rows.get(key)
+        return row is not None and self.versions[row] == self.version
+
+    def missing(self, paths):
+        """ Paths of the files whose content has no row of the current
+            version, i.e. new or changed images
+        """
+        return [path for path in paths if file_digest(path) not in self]
+
+    def append(self, keys, columns, names=None):
+        """ Adds rows for new keys, see upsert
+        """
+        existing = [key for key in keys if key in self._rows]
+        if existing:
+            raise ValueError("keys already in the store: %s" % existing[:3])
+        self.upsert(keys, columns, names)
+
+    def upsert(self, keys, columns, names=None):
+        """ Adds or replaces the rows of keys
+            Input:
+                - keys: content hashes of the source images
+                - columns: dict column name -> values, one per key
+                - names: optional source filenames of the keys
+        """
+        keys = list(keys)
+        schema = dict(self.columns)
+        rows = []
+        for i, key in enumerate(keys):
+            if key not in self._rows:
+                self._rows[key] = len(self.keys)
+                self.keys.append(key)
+                self.names.append(None)
+                self.versions.append(None)
+            row = self._rows[key]
+            self.versions[row] = self.version
+            if names is not None:
+                self.names[row] = names[i]
+            rows.append(row)
+        os.makedirs(self.path, exist_ok=True)
+        for name in list(self.columns) + [x for x in columns 
+                                            if x not in self.columns]:
+            if name in columns:
+                values = np.asarray(columns[name])
+                if values.dtype.kind not in "f":
+                    values = values.astype(np.float64)
+                if len(values) != len(keys):
+                    raise ValueError("column %s has %d values for %d keys" %
+                                        (name, len(values), len(keys)))
+            elif self._capacity(name) >= len(self.keys):
+                # untouched column, its spare rows already hold NaN
+                continue
+            else:
+                values = None
+            data = self._grown(name, values)
+            if values is not None:
+                data[rows] = values
+            data.flush()
+            del data
+        if self.columns != schema or \
+                self._journal + len(rows) > max(len(self.keys), 1024):
+            self._save_index()
+        else:
+            self._append_journal(rows)
+
+    def read(self, columns=None, keys=None):
+        """ Reads columns of the store
+            Input:
+                - columns: names of the columns, all if None
+                - keys: keys of the rows, in the returned order, all the
+                    rows of the current version if None
+            Returns:
+                - dict column name -> array with a row per key
+        """
+        if columns is None:
+            columns = list(self.columns)
+        if keys is None:
+            rows = [i for i, v in enumerate(self.versions) if v == self.version]
+        else:
+            rows = [self._rows[key] for key in keys]
+        out = {}
+        for name in columns:
+            if name not in self.columns:
+                raise KeyError("no column %s in the store" % name)
+            data = np.load(self._column_path(name), mmap_mode="r")
+            out[name] = data[rows]
+        return out
+
+    def iter_chunks(self, columns, chunksize=4096):
+        """ Streams the rows of the current version in chunks, reading
+            only chunksize rows of every column at a time
+            Yields:
+                - (keys, matrix) of every chunk, matrix being the
+                    float64 (rows, features) array of columns
+        """
+        rows = np.array([i for i, v in enumerate(self.versions)
+                            if v == self.version], dtype=np.int64)
+        data = [np.load(self._column_path(name), mmap_mode="r")
+                    for name in columns]
+        for start in range(0, len(rows), chunksize):
+            chunk = rows[start:start+chunksize]
+            matrix = np.hstack([np.asarray(x[chunk], np.float64)
+                                    .reshape(len(chunk), -1) for x in data])
+            yield [self.keys[i] for i in chunk], matrix
+
+    def matrix(self, columns, keys=None):
+        """ Columns stacked as a contiguous (rows, features) array, e.g.
+            the classifier input
+        """
+        data = self.read(columns, keys)
+        return np.ascontiguousarray(np.hstack(
+            [data[name].reshape(len(data[name]), -1) for name in columns]))
+
+    def _grown(self, name, values):
+        """ Column name memory mapped for writing, with room for a row
+            per key, the rows never written holding NaN
+        """
+        path = self._column_path(name)
+        if name in self.columns:
+            data = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            data = _allocate(path, max(len(self.keys), MIN_CAPACITY),
+                                values.dtype, values.shape[1:])
+        if values is not None and data.shape[1:] != values.shape[1:]:
+            raise ValueError("column %s holds values of shape %s, not %s" %
+                                (name, data.shape[1:], values.shape[1:]))
+        if len(data) < len(self.keys):
+            # doubling the capacity keeps appends amortised constant
+            data = _allocate(path, max(len(self.keys), 2*len(data)),
+                                data.dtype, data.shape[1:], data)
+        self.columns[name] = [data.dtype.str, list(data.shape[1:])]
+        return data
+
+    def _capacity(self, name):
+        return len(np.load(self._column_path(name), mmap_mode="r"))
+
+    def _column_path(self, name):
+        return os.path.join(self.path, name + ".npy")
+
+    def _save_index(self):
+        """ Writes the whole index, emptying the journal
+        """
+        path = os.path.join(self.path, "index.json")
+        with open(path + ".tmp", "w") as f:
+            f.write(json.dumps({'keys': self.keys, 'names': self.names,
+                                'versions': self.versions,
+                                'columns': self.columns}))
+        os.replace(path + ".tmp", path)
+        # the journal entries are in the index, replaying them is
+        # harmless if we stop before the truncation
+        open(os.path.join(self.path, "index.journal"), "w").close()
+        self._journal = 0
+
+    def _append_journal(self, rows):
+        """ Records the changed rows without rewriting the index, which
+            is rewritten once the journal holds as many rows as it
+        """
+        with open(os.path.join(self.path, "index.journal"), "a") as f:
+            f.write("".join(json.dumps([row, self.keys[row], self.names[row],
+                                        self.versions[row]]) + "\n"
+                            for row in rows))
+        self._journal += len(rows)
+
+    def _replay(self, entry):
+        row, key, name, version = entry
+        if row == len(self.keys):
+            self.keys.append(key)
+            self.names.append(name)
+            self.versions.append(version)
+        else:
+            self.keys[row], self.names[row], self.versions[row] = \
+                key, name, version
+        self._journal += 1
+
+
+def _allocate(path, capacity, dtype, shape, old=None):
+    """ Writes a column file of capacity rows, starting with the rows
+        of old (if any) and NaN in the others
+        Returns:
+            - the file memory mapped for writing
+    """
+    tmp = path + ".tmp.npy"
+    data = np.lib.format.open_memmap(tmp, mode="w+", dtype=dtype,
+                                        shape=(capacity,) + tuple(shape))
+    start = 0 if old is None else len(old)
+    for i in range(0, start, COPY_ROWS):
+        end = min(i + COPY_ROWS, start)
+        data[i:end] = old[i:end]
+    data[start:] = np.nan
+    data.flush()
+    os.replace(tmp, path)
+    return data
+
+def file_digest(path):
+    """ Hash of the content of a file
+    """
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def _texture(gray, mask):
+    """ Uniformity (sum of the squared probabilities of a 256 bins
+        histogram) and standard deviation of the gray values, in 
+        [0, 256), inside mask
+    """
+    values = np.asarray(gray)[np.asarray(mask)]
+    if values.size == 0:
+        return np.nan, np.nan
+    p = np.histogram(values, bins=256, range=(0, 256))[0] / values.size
+    return float(np.sum(p**2)), float(np.std(values))
+
+def _percent(part, whole):
+    """ 100*part/whole, NaN when whole is not positive (e.g. NaN when
+        no embryo was found), so that the row is one missing features
+        (see Classifier.train) and not an inf
+    """
+    if not whole > 0:
+        return np.nan
+    return 100*part/whole
+
+def image_features(orig, index, hog_shape=HOG_SHAPE):
+    """ Segments a single original image and measures it, as the
+        stages of generate_images and main.
+        Input:
+            - orig: original diplib image
+            - index: position of the image in the natsorted series,
+                used to choose the threshold method
+        Returns:
+            - dict column name -> value (float or float32 vector), the
+                embryo columns and the ratios to them being NaN when no
+                embryo is found
+    """
+    method = threshold_method(index)
+    embr_norm = normalize_resize_image(orig)
+    embr_gray = embryo_gray(orig)
+    embr_transf = transform_image(threshold_image(embr_gray, method))
+    embr_mask = largest_object_mask(embr_norm, embr_transf)
+    blue_channel = blue_gray(blue_resize(orig))
+    blue_thresh = invert_image(threshold_image(blue_channel, method))
+    blue_transf = dip.FillHoles(mask_image(blue_thresh, embr_mask))
+
+    # the method depends on the position of the image in its series,
+    # which can change as images are added, see stale_keys
+    out = {'threshold_method': float(THRESHOLD_METHODS.index(method))}
+    _, embr_mes = measure_image(embr_mask, embr_gray, FEATURES)
+    if embr_mes.NumberOfObjects() == 0:
+        for name in ['area', 'perimeter', 'circularity', 'roundness', 'std']:
+            out[name] = np.nan
+        minimum, maximum = [0, 0], [x-1 for x in embr_mask.Sizes()]
+    else:
+        (area, perimeter, circularity, roundness, std, minimum,
+            maximum) = [x[0] for x in measurements_array([embr_mes], FEATURES)]
+        out.update(area=area, perimeter=perimeter, circularity=circularity,
+                    roundness=roundness, std=std)
+    _, blue_mes = measure_image(blue_transf, blue_channel, ['Size', 'Perimeter'])
+    values, columns = measurement_table(blue_mes)
+    out['blue_objects'] = len(values)
+    out['blue_area'] = values[:, columns.index('Size')].sum() if len(values) else 0.0
+    out['blue_perimeter'] = values[:, columns.index('Perimeter')].sum() if len(values) else 0.0
+    out['blue_area_pct'] = _percent(out['blue_area'], out['area'])
+    out['blue_perimeter_pct'] = _percent(out['blue_perimeter'],
+                                            out['perimeter'])
+    out['unif_embryo'], out['std_embryo'] = _texture(embr_gray, embr_mask)
+    out['unif_blue'], out['std_blue'] = _texture(blue_channel, blue_transf)
+    # texture of the blue area and of the rest of the embryo, see
+    # texture_columns
+    out['texture'] = texture_features(embr_norm, embr_mask, blue_transf)
+    # HOG of the embryo and of its blue region, cropped to the embryo
+    size = embr_mask.Sizes()
+    embr_crop = crop_image(embr_mask, minimum, maximum, size)
+    blue_crop = crop_image(blue_transf, minimum, maximum, size)
+    out['hog'] = hog_descriptors(embr_crop, blue_crop, shape=hog_shape)
+    return out
+
+def stale_keys(store, keys, indices):
+    """ Positions of the keys without a row of the current version in
+        store, or whose row was computed with another threshold method
+        than the one of their index in the series
+        Input:
+            - keys: content hashes of the images
+            - indices: position of every image in its natsorted series
+    """
+    stored = np.full(len(keys), np.nan)
+    present = [i for i, key in enumerate(keys) if key in store]
+    if present and 'threshold_method' in store.columns:
+        # rows stored before the column was added hold NaN
+        stored[present] = store.read(['threshold_method'],
+                            [keys[i] for i in present])['threshold_method']
+    return [i for i in range(len(keys)) if stored[i] !=
+                THRESHOLD_METHODS.index(threshold_method(indices[i]))]
+
+def named_features(path, index):
+    """ image_features of the image file path, for the worker processes
+    """
+    return image_features(dip.ImageReadTIFF(path), index)
+
+def update_store(store, images_dir, workers=1, chunksize=1, force=False):
+    """ Computes the features of the images of images_dir that are not
+        in store yet (new or changed files, or files whose position in
+        the series changed their threshold method) and adds them to it
+        Returns:
+            - filenames of the processed images
+    """
+    if images_dir[-1] != "/":
+        images_dir += "/"
+    filenames = [x for x in natsorted(os.listdir(images_dir))
+                    if ".tif" in x and x[-5] in "0123456789"]
+    # the position in the series chooses the threshold method
+    indices = {name: i for i, name in enumerate(filenames)}
+    digests = {name: file_digest(images_dir+name) for name in filenames}
+    todo = filenames
+    if not force:
+        stale = stale_keys(store, [digests[name] for name in filenames],
+                            [indices[name] for name in filenames])
+        todo = [filenames[i] for i in stale]
+    if not todo:
+        return []
+    keys = [digests[name] for name in todo]
+    rows = parallel_map(named_features, [images_dir+name for name in todo],
+                        [indices[name] for name in todo],
+                        workers=workers, chunksize=chunksize)
+    columns = {name: [row[name] for row in rows] for name in rows[0]}
+    store.upsert(keys, columns, names=todo)
+    return todo
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Adds the features of the "
+                                    "new or changed images to the store")
+    parser.add_argument("images_dir", nargs="?", default="data/")
+    parser.add_argument("--store", default="features",
+                        help="directory of the feature store")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    parser.add_argument("--chunksize", type=int, default=1)
+    parser.add_argument("--force", action="store_true",
+                        help="compute the features of every image again")
+    args = parser.parse_args()
+    store = FeatureStore(args.store)
+    done = update_store(store, args.images_dir, args.workers or None,
+                        args.chunksize, args.force)
+    print("Processed %d images, %d in the store" % (len(done), len(store)))
@@ -1,39 +1,160 @@
+import argparse
+import os
+from itertools import count
 import diplib as dip
 import numpy as np
 from utilities import *
+from stage_cache import StageCache
+from image_writer import ImageWriter
+from stage_graph import StageGraph
+import instrument
 
 
-def main():
-    parent_dir = "transformed/"
-    orig_images, _ = load_dip_images('data/')
+def embryo_gray(orig, kernel=30, threshold=10):
+    """ Kuwahara smoothed, rescaled blue channel used to segment
+        the embryos
+    """
+    # only the blue channel is normalized and resized
+    blue = np.asarray(dip.Kuwahara(orig, kernel, threshold))[:,:,2]
+    return normalize_resize_image(blue)
 
+def blue_resize(orig):
+    """ uint8 rescaled image used to segment the blue areas
+    """
+    return check_dtype(normalize_resize_image(dip.Convert(orig, "UINT8"), 
+                                                normalize=False), "UINT8")
+
+def blue_gray(uint_rescaled, sigmas=(3,3)):
+    """ Gauss smoothed red channel of the blue resized image
+    """
+    return dip.Gauss(uint_rescaled(0), sigmas=list(sigmas))
+
+def process_image(orig, index, cache=None):
+    """ Runs a single original image through every stage of main.
+        Input:
+            - orig: original diplib image
+            - index: position of the image in the natsorted series,
+                used to choose the threshold method
+            - cache: optional StageCache for the expensive stages
+        Yields:
+            - (directory, name_temp, image) tuples in the order
+                main saves them
+    """
+    stage = cache.wrap if cache is not None else lambda func: func
     # create original rescaled images
-    embr_norm = normalize_resize(orig_images)
-    save_images(embr_norm, parent_dir+"orig_resize", "orig_resize")
-
-    # generate embryos images
-    embryos =  [dip.Kuwahara(x, 30, 10) for x in orig_images ]
-    embryos = normalize_resize(embryos)
-    # choose relevant channel
-    embr_gray = [ dip.Image(np.array(x)[:,:,2]) for x in embryos]
+    embr_norm = stage(normalize_resize_image)(orig)
+    yield "orig_resize", "orig_resize", embr_norm
+    # generate embryos images in the relevant channel
+    embr_gray = stage(embryo_gray)(orig)
     # threshold
-    embr_thresh = threshold_images(embr_gray)
-    save_images(embr_thresh, parent_dir+"embr_thresh", "thresh")
+    embr_thresh = stage(threshold_image)(embr_gray, threshold_method(index))
+    yield "embr_thresh", "thresh", embr_thresh
     # transform
-    embr_transf = apply_transformations(embr_thresh)
-    save_images(embr_transf, parent_dir+"embr_transf", "transf")
+    embr_transf = stage(transform_image)(embr_thresh)
+    yield "embr_transf", "transf", embr_transf
+    # create image of focused embryo element
+    embryo_masked = stage(largest_object_mask)(embr_norm, embr_transf)
+    yield 'embryo_masks', 'mask', embryo_masked
+    # original image with mask
+    yield "orig_rel", "orig_rel", mask_image(embr_norm, embryo_masked)
+
+    # generate blues
+    uint_rescaled = stage(blue_resize)(orig)
+    yield "blue_resize", "blue_resize", uint_rescaled
+    # apply gauss and choose relevant channel
+    blue_channel = stage(blue_gray)(uint_rescaled)
+    # threshold
+    blue_thresh = stage(threshold_image)(blue_channel, threshold_method(index))
+    invert_image(blue_thresh, out=blue_thresh)
+    # take only blue threshold of embryo
+    blue_rel_thresh = mask_image(blue_thresh, embryo_masked)
+    yield "blue_thresh", "blue_thresh", blue_rel_thresh
+    # fill holes in image
+    blue_transf = dip.FillHoles(blue_rel_thresh)
+    yield "blue_transf", "blue_transf", blue_transf
+    # create original image only blue
+    yield "blue_rel_orig", "blue_rel_orig", mask_image(embr_norm, blue_transf)
+
+def process_outputs(orig, index, cache=None):
+    """ List version of process_image, used by the worker processes
+    """
+    return list(process_image(orig, index, cache))
+
+def main_stream(images_dir='data/', parent_dir="transformed/", 
+                workers=1, chunksize=1, cache=None, writer=None):
+    """ Streaming version of main: every image goes through all the
+        stages and is written out before the next one is loaded, so
+        memory is bounded by a single image (per worker) instead of
+        the dataset.
+    """
+    names = []
+    def origs():
+        for orig, name in iter_dip_images(images_dir):
+            names.append(name)
+            yield orig
+    outputs = parallel_imap(partial(process_outputs, cache=cache), 
+                            origs(), count(), 
+                            workers=workers, chunksize=chunksize)
+    for index, images in enumerate(outputs):
+        for directory, name_temp, img in images:
+            save_image(img, parent_dir+directory, name_temp, index, 
+                        writer=writer)
+    instrument.set_image_names(names)
+
+def fill_holes(dip_images: list):
+    return [dip.FillHoles(x) for x in dip_images]
+
+def _load_originals(images_dir):
+    orig_images, names = load_dip_images(images_dir)
+    instrument.set_image_names(names)
+    return orig_images
+
+def main(images_dir='data/', parent_dir="transformed/", workers=1, 
+            chunksize=1, cache=None, writer=None, branches=1):
+    """ Runs the stages over the whole series, one stage at a time.
+        The stages form a StageGraph, so each one is computed once
+        and its images are released once its last consumer is done.
+        Input:
+            - images_dir: directory (or stack) of the original images
+            - parent_dir: directory the outputs are saved in
+            - workers, chunksize, cache: see parallel_map, used by
+                every stage to process the images
+            - writer: optional ImageWriter or StackStore
+            - branches: number of stages run at the same time (in
+                threads), the embryo and blue branches being
+                independent; the workers are shared out between them
+    """
+    if parent_dir[-1] != "/":
+        parent_dir += "/"
+    if branches > 1 and workers != 1:
+        # every running stage has its own pool, they share the cores
+        workers = max(1, (workers or os.cpu_count()) // branches)
+    pool = dict(workers=workers, chunksize=chunksize, cache=cache)
+    graph = StageGraph()
+    def save(images, directory, name_temp):
+        graph.add("save_"+directory, save_images, images, local=True, 
+                    images_dir=parent_dir+directory, name_temp=name_temp, 
+                    writer=writer)
+
+    # create original rescaled images
+    graph.add("embr_norm", normalize_resize, "orig", **pool)
+    save("embr_norm", "orig_resize", "orig_resize")
+
+    # generate embryos images in the relevant channel
+    graph.add("embr_gray", partial(parallel_map, embryo_gray), "orig", **pool)
+    # threshold
+    graph.add("embr_thresh", threshold_images, "embr_gray", **pool)
+    save("embr_thresh", "embr_thresh", "thresh")
+    # transform
+    graph.add("embr_transf", apply_transformations, "embr_thresh", **pool)
+    save("embr_transf", "embr_transf", "transf")
     # create images of focused embryo element
-    embryo_masked = embryo_mask(embr_norm, embr_transf)
-    save_images(embryo_masked,parent_dir+'embryo_masks', 'mask')
+    graph.add("embryo_masked", embryo_mask, "embr_norm", "embr_transf")
+    save("embryo_masked", 'embryo_masks', 'mask')
     # original images with mask
-    wheres = [np.where(x == 0) for x in embryo_masked]
-    orig_rel = []
-    for i in range(len(embr_norm)):
-        new_img = np.array(embr_norm[i])
-        mask = wheres[i]
-        new_img[mask[0], mask[1]] = 0
-        orig_rel.append(dip.Image(new_img))
-    save_images(orig_rel,parent_dir+"orig_rel", "orig_rel")
+    graph.add("orig_rel", mask_images, "embr_norm", "embryo_masked", 
+                local=True)
+    save("orig_rel", "orig_rel", "orig_rel")
     
     # # label images to crop
     # features = ['Minimum','Maximum', 'Size']
@@ -60,42 +181,33 @@ def main():
     # save_images(embr_gray, parent_dir+"crop_embr_gray", "gray")
 
     # generate blues
-    orig_uint = [dip.Convert(x, "UINT8") for x in orig_images]
-    uint_rescaled = normalize_resize(orig_uint, normalize=False)
-    save_images(uint_rescaled,parent_dir+"blue_resize", "blue_resize")
-    # apply gauss
-    blue_gauss = [dip.Gauss(x,sigmas=[3,3]) for x in uint_rescaled]
-    # choose relevant channel
-    blue_gray = [ dip.Image(np.array(x)[:,:,0]) for x in blue_gauss]
+    graph.add("uint_rescaled", partial(parallel_map, blue_resize), "orig", 
+                **pool)
+    save("uint_rescaled", "blue_resize", "blue_resize")
+    # apply gauss and choose relevant channel
+    graph.add("blue_channels", partial(parallel_map, blue_gray), 
+                "uint_rescaled", **pool)
     # threshold
-    blue_inverted = threshold_images(blue_gray)
-    blue_thresh = invert_colors(blue_inverted)
+    graph.add("blue_inverted", threshold_images, "blue_channels", **pool)
+    graph.add("blue_thresh", invert_colors, "blue_inverted", local=True,
+                inplace=True)
 
     # take only blue threshold of embryo
     # relative to embryo mask calculated earlier
-    wheres = [np.where(x == 0) for x in embryo_masked]
-    blue_rel_thresh = []
-    blue_rel_orig = []
-    for i in range(len(blue_thresh)):
-        # thresholded
-        new_img = np.array(blue_thresh[i])
-        mask = wheres[i]
-        new_img[mask[0], mask[1]] = 0
-        blue_rel_thresh.append(dip.Image(new_img))
-    save_images(blue_rel_thresh,parent_dir+"blue_thresh", "blue_thresh")
+    graph.add("blue_rel_thresh", mask_images, "blue_thresh", 
+                "embryo_masked", local=True)
+    save("blue_rel_thresh", "blue_thresh", "blue_thresh")
     # fill holes in images
-    blue_transf = [ dip.FillHoles(x) for x in blue_rel_thresh ]
-    save_images(blue_transf,parent_dir+"blue_transf", "blue_transf")
+    graph.add("blue_transf", fill_holes, "blue_rel_thresh", local=True)
+    save("blue_transf", "blue_transf", "blue_transf")
     # create original images only blue
-    blue_rel_orig = []
-    wheres = [np.where(x == 0) for x in blue_transf]
-    for i in range(len(blue_transf)):
-        # original
-        new_img = np.array(embr_norm[i])
-        mask = wheres[i]
-        new_img[mask[0], mask[1]] = 0
-        blue_rel_orig.append(dip.Image(new_img))
-    save_images(blue_rel_orig,parent_dir+"blue_rel_orig", "blue_rel_orig")
+    graph.add("blue_rel_orig", mask_images, "embr_norm", "blue_transf", 
+                local=True)
+    save("blue_rel_orig", "blue_rel_orig", "blue_rel_orig")
+
+    # the originals are only referenced by the graph, which releases
+    # them after their last consumer
+    graph.run(workers=branches, orig=_load_originals(images_dir))
     
     # # crop relevant area based on embryos boundaries
     # blue_thresh = crop_images(blue_thresh, minimum=mins, maximum=maxs)
@@ -173,4 +285,53 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="data/",
+                        help="directory (or stack) of the original images")
+    parser.add_argument("--output", default="transformed/",
+                        help="directory the outputs are saved in")
+    parser.add_argument("--stream", action="store_true",
+                        help="process and save one image at a time")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    parser.add_argument("--chunksize", type=int, default=1,
+                        help="images sent to a worker at once")
+    parser.add_argument("--branches", type=int, default=1,
+                        help="independent stages run at the same time")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of the stage cache, no cache if unset")
+    parser.add_argument("--cache-size", type=int, default=2048,
+                        help="size cap of the stage cache in MB")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="processes writing the images in the background, "
+                            "0 to write them synchronously")
+    parser.add_argument("--stack", action="store_true",
+                        help="save every directory of images as a single "
+                            "memory mappable stack file")
+    parser.add_argument("--report", default=None,
+                        help="write a JSON report of the stages to this file")
+    parser.add_argument("--per-image", action="store_true",
+                        help="include the time of every image in the report")
+    args = parser.parse_args()
+    if args.report is not None:
+        instrument.enable(per_image=args.per_image)
+    workers = args.workers or None
+    output = args.output if args.output[-1] == "/" else args.output + "/"
+    cache = None
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, args.cache_size*1024**2)
+    writer = None
+    if args.stack:
+        writer = StackStore()
+    elif args.writers > 0:
+        writer = ImageWriter(workers=args.writers)
+    if args.stream:
+        main_stream(args.input, output, workers=workers, 
+                    chunksize=args.chunksize, cache=cache, writer=writer)
+    else:
+        main(args.input, output, workers=workers, chunksize=args.chunksize, 
+                cache=cache, writer=writer, branches=args.branches)
+    if writer is not None:
+        writer.close()
+    if args.report is not None:
+        instrument.write_report(args.report)
\ No newline at end of file
@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import struct
+import numpy as np
+import diplib as dip
+import instrument
+
+
+# a stack file is a 64 bytes header, the raw pixels of every image and
+# a JSON index (name, dtype, shape and offset of every image) at the end
+STACK_EXTENSION = ".stack"
+MAGIC = b"DIPSTACK"
+VERSION = 1
+HEADER = struct.Struct("<8sIxxxxQQ")
+DATA_OFFSET = 64
+
+
+class StackWriter:
+    """ Writes a series of images to a single stack file, one image at
+        a time, so that they can later be memory mapped by ImageStack
+        instead of decoded from one tif file each.
+        Images with the same dtype and shape are stored back to back,
+        a stack of such images can be viewed as a single array.
+
+        Params:
+            - path: path of the stack file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._tmp = path + ".%d.tmp" % os.getpid()
+        self._file = open(self._tmp, "wb")
+        self._file.write(bytes(DATA_OFFSET))
+        self._offset = DATA_OFFSET
+        self._index = []
+
+    def append(self, img, name=None):
+        """ Appends img (a dip image or a numpy array) to the stack
+        """
+        tensor = isinstance(img, dip.Image) and img.TensorElements() > 1
+        arr = np.ascontiguousarray(img)
+        # align every image on the size of its elements
+        padding = -self._offset % arr.dtype.itemsize
+        if padding:
+            self._file.write(bytes(padding))
+            self._offset += padding
+        self._file.write(arr.data)
+        self._index.append({'name': name, 'dtype': arr.dtype.str,
+                            'shape': list(arr.shape), 'tensor': tensor,
+                            'offset': self._offset})
+        self._offset += arr.nbytes
+
+    def close(self):
+        """ Writes the index and moves the stack to its final path
+        """
+        if self._file.closed:
+            return
+        index = json.dumps({'images': self._index}).encode()
+        self._file.write(index)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self._offset, len(index)))
+        self._file.close()
+        os.replace(self._tmp, self.path)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not leave a truncated stack behind
+            self._file.close()
+            os.remove(self._tmp)
+        return False
+
+
+class ImageStack:
+    """ Read only, memory mapped view of a stack file. Images are
+        returned as dip images sharing the memory of the file, so
+        nothing is read before the pixels are actually used.
+
+        Params:
+            - path: path of the stack file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, index_offset, index_size = \
+                HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(path + " is not an image stack")
+            if version > VERSION:
+                raise ValueError("unsupported stack version %d" % version)
+            f.seek(index_offset)
+            self._index = json.loads(f.read(index_size))['images']
+        if index_offset > DATA_OFFSET:
+            self._map = np.memmap(path, dtype=np.uint8, mode="r",
+                                    shape=(index_offset,))
+        else:
+            self._map = None
+        self.names = [entry['name'] for entry in self._index]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        entry = self._index[i]
+        arr = self.array(i)
+        return dip.Image(arr, arr.ndim-1 if entry['tensor'] else None)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def array(self, i):
+        """ Numpy view of the pixels of image i
+        """
+        entry = self._index[i]
+        return np.ndarray(entry['shape'], np.dtype(entry['dtype']),
+                            buffer=self._map, offset=entry['offset'])
+
+    def as_array(self):
+        """ View of the whole stack as a single array, first axis being
+            the image. Only for stacks of images of the same dtype and
+            shape.
+        """
+        if not self._index:
+            raise ValueError("empty stack")
+        first = self._index[0]
+        nbytes = np.dtype(first['dtype']).itemsize * \
+                    int(np.prod(first['shape']))
+        for i, entry in enumerate(self._index):
+            if entry['dtype'] != first['dtype'] or \
+                    entry['shape'] != first['shape'] or \
+                    entry['offset'] != first['offset'] + i*nbytes:
+                raise ValueError("images of the stack differ in dtype "
+                                    "or shape")
+        return np.ndarray([len(self)] + first['shape'],
+                            np.dtype(first['dtype']), buffer=self._map,
+                            offset=first['offset'])
+
+
+class StackStore:
+    """ Storage backend that can be passed as writer to save_images
+        and save_image: every directory of images becomes a single
+        stack file (e.g. transformed/orig_resize.stack) instead of one
+        tif file per image. Stacks hold the pixels themselves, so an
+        image saved in several formats is stored once (save_images
+        writes it once with all its formats), and an image saved again
+        under the same name replaces the previous one when the stack is
+        loaded. Stacks are written on close.
+    """
+
+    def __init__(self):
+        self._writers = {}
+
+    def write(self, img, path, file_type="tif"):
+        """ Appends img to the stack of its directory, every call
+            storing it once whatever file_type (a format or a list)
+        """
+        directory, name = os.path.split(path)
+        if directory not in self._writers:
+            self._writers[directory] = StackWriter(stack_path(directory))
+        self._writers[directory].append(img, name + ".tif")
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def stack_path(images_dir):
+    """ Path of the stack file holding the images of images_dir
+    """
+    return images_dir.rstrip("/") + STACK_EXTENSION
+
+def is_stack(path):
+    return path.endswith(STACK_EXTENSION) and os.path.isfile(path)
+
+def iter_stack(path):
+    """ Images of a stack, as iter_dip_images, the images saved more
+        than once under the same name being yielded once (the last one)
+        Yields:
+            - (dip_image, filename) tuples
+    """
+    with instrument.stage("read_stack", 0):
+        stack = ImageStack(path)
+    last = {name: i for i, name in enumerate(stack.names)}
+    for i, name in enumerate(stack.names):
+        if name is not None and last[name] != i:
+            continue
+        yield stack[i], name
+
+def write_stack(dip_images: list, path, names=None):
+    """ Writes dip_images to a single stack file
+        Input:
+            - dip_images: python list with the images to save
+            - path: path of the stack file
+            - names: optional filenames stored along the images
+    """
+    with StackWriter(path) as writer:
+        for i, img in enumerate(dip_images):
+            writer.append(img, names[i] if names is not None else None)
+
+
+if __name__ == "__main__":
+    # converts directories of tif images into stacks
+    from utilities import iter_dip_images
+    for images_dir in sys.argv[1:]:
+        with StackWriter(stack_path(images_dir)) as writer:
+            for img, name in iter_dip_images(images_dir):
+                writer.append(img, name)
+        print("Saved", stack_path(images_dir), len(writer), "images")
@@ -0,0 +1,165 @@
+import os
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utilities import (pack_images, unpack_images, write_image_file,
+                        image_digest, FILE_EXTENSIONS)
+import instrument
+
+
+# file kept in every output directory with the digests of its images
+DIGESTS_FILE = ".image_digests.json"
+
+
+class ImageWriter:
+    """ Writes images in the background, so that computing the next
+        stage does not wait for the disk.
+        diplib holds the GIL while encoding, so by default the images
+        are written by worker processes; processes=False uses threads
+        instead. At most max_pending writes are queued, write blocks
+        when the queue is full. Writes to the same file are kept in
+        order, and an image identical to the file already on disk
+        (as recorded in the digests file of its directory) is skipped.
+
+        Params:
+            - workers: number of writer processes (or threads)
+            - max_pending: size of the queue of pending writes
+            - processes: write in processes instead of threads
+            - skip_unchanged: do not rewrite files with the same content
+    """
+
+    def __init__(self, workers=2, max_pending=16, processes=True,
+                    skip_unchanged=True):
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self._pool = executor(max_workers=workers)
+        self.processes = processes
+        self.max_pending = max_pending
+        self.skip_unchanged = skip_unchanged
+        self.written = 0
+        self.skipped = 0
+        self._pending = deque()
+        self._by_path = {}
+        self._digests = {}
+        self._errors = []
+        self._closed = False
+
+    def write(self, img, path, file_type="tif"):
+        """ Queues the write of img to path (without extension)
+        """
+        if self._closed:
+            raise ValueError("write to a closed ImageWriter")
+        file_path = path + FILE_EXTENSIONS[file_type]
+        digest = image_digest(img) + file_type if self.skip_unchanged else None
+        if digest is not None and self._unchanged(file_path, digest):
+            self.skipped += 1
+            return
+        # keep the writes of a same file in order
+        previous = self._by_path.get(file_path)
+        if previous is not None:
+            self._wait(previous)
+        while len(self._pending) >= self.max_pending:
+            self._collect(self._pending[0])
+        if self.processes:
+            img = pack_images(img)
+        future = self._pool.submit(_write, img, path, file_type)
+        entry = (future, file_path, digest)
+        self._pending.append(entry)
+        self._by_path[file_path] = entry
+
+    def flush(self):
+        """ Waits for every pending write and saves the digests.
+            Raises an OSError if any write failed since the last flush.
+        """
+        while self._pending:
+            self._collect(self._pending[0])
+        self._save_digests()
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise OSError("failed to write %d images, first: %s: %s" %
+                            (len(errors), errors[0][0], errors[0][1])) \
+                    from errors[0][1]
+
+    def close(self):
+        """ Flushes and stops the workers
+        """
+        if self._closed:
+            return
+        try:
+            self.flush()
+        finally:
+            self._closed = True
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _wait(self, entry):
+        if entry in self._pending:
+            self._collect(entry)
+
+    def _collect(self, entry):
+        """ Waits for the write of entry and records its outcome
+        """
+        future, file_path, digest = entry
+        self._pending.remove(entry)
+        if self._by_path.get(file_path) is entry:
+            del self._by_path[file_path]
+        try:
+            future.result()
+        except Exception as e:
+            self._errors.append((file_path, e))
+            self._digests_of(file_path).pop(os.path.basename(file_path), None)
+            return
+        self.written += 1
+        if digest is not None:
+            stat = os.stat(file_path)
+            self._digests_of(file_path)[os.path.basename(file_path)] = \
+                [digest, stat.st_size, stat.st_mtime_ns]
+
+    def _unchanged(self, file_path, digest):
+        if file_path in self._by_path:
+            # a different write of this file is still pending
+            return self._by_path[file_path][2] == digest
+        entry = self._digests_of(file_path).get(os.path.basename(file_path))
+        if entry is None or entry[0] != digest:
+            return False
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return False
+        # the file must not have been modified since it was written
+        return [stat.st_size, stat.st_mtime_ns] == entry[1:]
+
+    def _digests_of(self, file_path):
+        """ Digests of the directory of file_path, loaded on first use
+        """
+        directory = os.path.dirname(file_path)
+        if directory not in self._digests:
+            try:
+                with open(os.path.join(directory, DIGESTS_FILE)) as f:
+                    self._digests[directory] = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._digests[directory] = {}
+        return self._digests[directory]
+
+    def _save_digests(self):
+        for directory, digests in self._digests.items():
+            if not os.path.isdir(directory):
+                # every write to it failed
+                continue
+            path = os.path.join(directory, DIGESTS_FILE)
+            tmp = path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump(digests, f)
+            os.replace(tmp, path)
+
+
+def _write(img, path, file_type):
+    # in a writer thread, the io would otherwise count for the stages
+    # running meanwhile
+    with instrument.background():
+        return write_image_file(unpack_images(img), path, file_type)
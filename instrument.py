@@ -0,0 +1,370 @@
+import os
+import sys
+import json
+import time
+import threading
+from functools import wraps
+
+
+# active recorder, None when instrumentation is disabled
+_recorder = None
+
+
+class Recorder:
+    """ Collects the per stage statistics of a run. Stages can run in
+        several threads (e.g. the branches of a StageGraph) and
+        background work (e.g. ImageWriter threads) meanwhile, so the
+        statistics are updated under a lock, and the calls overlapping
+        work of other threads are tracked: the CPU time and the io
+        counters are process wide, such calls do not count their io.
+
+        Params:
+            - per_image: also record the time spent on every image
+    """
+
+    def __init__(self, per_image=False):
+        self.per_image = per_image
+        self.stages = {}
+        self.images = {}
+        self.image_names = None
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self._lock = threading.Lock()
+        # id -> (stage or background block, thread) of the running ones
+        self._running = {}
+
+    def begin(self, block):
+        """ Registers a running stage or background block, marking it
+            and the blocks of other threads running meanwhile as
+            overlapped
+        """
+        thread = threading.get_ident()
+        block.overlapped = False
+        with self._lock:
+            for other, other_thread in self._running.values():
+                if other_thread != thread:
+                    other.overlapped = block.overlapped = True
+            self._running[id(block)] = (block, thread)
+
+    def end(self, block):
+        """ Unregisters block
+            Returns:
+                - True if work of other threads ran meanwhile
+        """
+        with self._lock:
+            del self._running[id(block)]
+        return block.overlapped
+
+    def add(self, name, wall, cpu, read, written, images, peak,
+            overlapped=False):
+        """ Adds a call of stage name, read and written being None when
+            they can not be told apart from the work of other threads
+        """
+        with self._lock:
+            stage = self.stages.setdefault(name, {
+                'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0, 'read_bytes': 0,
+                'written_bytes': 0, 'images': 0, 'peak_rss_mb': 0.0,
+                'overlapped_calls': 0})
+            stage['calls'] += 1
+            stage['wall_s'] += wall
+            stage['cpu_s'] += cpu
+            stage['read_bytes'] += read or 0
+            stage['written_bytes'] += written or 0
+            stage['images'] += images
+            stage['peak_rss_mb'] = max(stage['peak_rss_mb'], peak/1024**2)
+            stage['overlapped_calls'] += overlapped
+
+    def add_image(self, name, index, seconds):
+        with self._lock:
+            self.images.setdefault(name, []).append([index, seconds])
+
+    def report(self):
+        """ Machine readable summary of the run
+        """
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in self.stages.items()}
+            images = {name: list(timings)
+                        for name, timings in self.images.items()}
+        report = {
+            'argv': sys.argv,
+            'pid': os.getpid(),
+            'wall_s': time.perf_counter() - self.start_wall,
+            'cpu_s': time.process_time() - self.start_cpu,
+            'children_cpu_s': _children_cpu(),
+            'max_rss_mb': _max_rss()/1024**2,
+            # how to read the per stage figures
+            'scope': {
+                'cpu_s': "process wide, includes the threads running "
+                            "meanwhile in overlapped calls",
+                'read_bytes': "process wide counters, or bytes known to the "
+                            "stage; overlapped calls only count the latter",
+                'written_bytes': "as read_bytes",
+                'peak_rss_mb': "process wide",
+            },
+            'stages': stages,
+        }
+        if self.per_image:
+            per_image = {}
+            for name, timings in images.items():
+                per_image[name] = [
+                    {'index': index, 'seconds': seconds,
+                     'name': self._image_name(index)}
+                    for index, seconds in timings]
+            report['per_image'] = per_image
+        return report
+
+    def _image_name(self, index):
+        if self.image_names is not None and index < len(self.image_names):
+            return self.image_names[index]
+        return None
+
+
+def enable(per_image=False):
+    """ Starts recording the instrumented stages
+    """
+    global _recorder
+    _recorder = Recorder(per_image)
+    return _recorder
+
+def disable():
+    global _recorder
+    _recorder = None
+
+def enabled():
+    return _recorder is not None
+
+def per_image():
+    """ True if the time of every image has to be recorded
+    """
+    return _recorder is not None and _recorder.per_image
+
+def set_image_names(names):
+    """ Filenames of the images, used to label the per image timings
+    """
+    if _recorder is not None:
+        _recorder.image_names = list(names)
+
+def record_image(name, index, seconds):
+    if _recorder is not None and _recorder.per_image:
+        _recorder.add_image(name, index, seconds)
+
+def report():
+    """ Report of the current run, None when disabled
+    """
+    if _recorder is None:
+        return None
+    return _recorder.report()
+
+def write_report(path):
+    """ Writes the report of the current run as JSON
+    """
+    if _recorder is None:
+        return
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2)
+
+
+class stage:
+    """ Context manager recording wall time, CPU time, bytes read and
+        written, image count and peak RSS of a block of code.
+        Costs a single check when instrumentation is disabled.
+
+        Params:
+            - name: name of the stage in the report
+            - images: number of images processed by the block
+        The block can set read_bytes / written_bytes when it knows
+        them better than procfs, e.g. for memory mapped reads. The
+        procfs counters are process wide, so a call overlapping work of
+        other threads (see Recorder) only records the bytes it set.
+    """
+
+    def __init__(self, name, images=0):
+        self.name = name
+        self.images = images
+        self.read_bytes = None
+        self.written_bytes = None
+        self._active = False
+
+    def __enter__(self):
+        if _recorder is None:
+            return self
+        self._active = True
+        self._recorder = _recorder
+        self._recorder.begin(self)
+        self._memory = PeakMemory().__enter__()
+        self._io = _io_counters()
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if not self._active:
+            return False
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        read, written = _io_counters()
+        read -= self._io[0]
+        written -= self._io[1]
+        self._memory.__exit__(*exc)
+        overlapped = self._recorder.end(self)
+        if overlapped:
+            read = written = None
+        if self.read_bytes is not None:
+            read = self.read_bytes
+        if self.written_bytes is not None:
+            written = self.written_bytes
+        self._recorder.add(self.name, wall, cpu, read, written, self.images,
+                            self._memory.peak_rss, overlapped)
+        return False
+
+class background:
+    """ Context manager marking work done outside the stages, e.g. by
+        the ImageWriter threads, so that the stages running meanwhile
+        do not count its io as theirs. Costs a single check when
+        instrumentation is disabled.
+    """
+
+    def __enter__(self):
+        self._recorder = _recorder
+        if self._recorder is not None:
+            self._recorder.begin(self)
+        return self
+
+    def __exit__(self, *exc):
+        if self._recorder is not None:
+            self._recorder.end(self)
+        return False
+
+def instrumented(name=None):
+    """ Decorator recording every call of a stage function, the image
+        count being the length of its first argument when it is a list
+        and 1 otherwise.
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            images = 1
+            if args and isinstance(args[0], (list, tuple)):
+                images = len(args[0])
+            with stage(stage_name, images):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class PeakMemory:
+    """ Context manager sampling the resident set size of the process
+        in a background thread, as diplib allocations are not visible
+        to tracemalloc. peak is the highest RSS above the one at entry
+        and peak_rss the highest RSS, in bytes.
+        The heap freed by earlier code is returned to the OS at entry
+        (see release_free_memory), otherwise a block reusing it would
+        not raise the RSS and would show no peak. Blocks allocating
+        below the mmap threshold of malloc can still reuse heap freed
+        inside them: benchmark measures every stage in a fresh process
+        with a fixed threshold for exact figures.
+    """
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak = 0
+        self.peak_rss = 0
+
+    def __enter__(self):
+        release_free_memory()
+        self._base = current_rss()
+        self._max = self._base
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._max = max(self._max, current_rss())
+        self.peak = self._max - self._base
+        self.peak_rss = self._max
+        return False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._max = max(self._max, current_rss())
+
+def _libc():
+    """ The C library when it is glibc, None otherwise
+    """
+    global _LIBC
+    if _LIBC is False:
+        _LIBC = None
+        if sys.platform.startswith("linux"):
+            try:
+                import ctypes
+                libc = ctypes.CDLL("libc.so.6")
+                libc.malloc_trim, libc.mallopt
+                _LIBC = libc
+            except (ImportError, OSError, AttributeError):
+                pass
+    return _LIBC
+
+_LIBC = False
+
+# mallopt parameter of the size above which malloc maps every block
+_M_MMAP_THRESHOLD = -3
+
+def release_free_memory():
+    """ Returns the free heap memory to the OS (glibc only), so that
+        the RSS counts only the live allocations
+    """
+    libc = _libc()
+    if libc is not None:
+        libc.malloc_trim(0)
+
+def fix_mmap_threshold(size=128*1024):
+    """ Makes malloc map every block larger than size (glibc only)
+        instead of raising the threshold as blocks are freed, so that
+        freed images are always unmapped and never reused from the heap
+    """
+    libc = _libc()
+    if libc is not None:
+        libc.mallopt(_M_MMAP_THRESHOLD, size)
+
+def current_rss():
+    """ Current resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # no procfs, fall back on the peak reported by the OS
+        return _max_rss()
+
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss*1024
+
+def _children_cpu():
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def _io_counters():
+    """ Bytes read and written by the process so far, from procfs
+    """
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(":") for line in f)
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
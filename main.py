@@ -1,55 +1,57 @@
-import diplib as dip
-import numpy as np
-import matplotlib.pyplot as plt
-import os
-import pandas as pd
-from skimage.io import imread
-from skimage.feature import hog
-import matplotlib.pyplot as plt
-from utilities import *
-from sklearn.cluster import KMeans
+import argparse
+import instrument
+from image_writer import ImageWriter
+from image_stack import StackStore
+from stage_cache import StageCache
+from pipeline import Run, run_stages
 
 
-def main():
-    features = ['Perimeter', 'Size',
-                'Circularity', 'Roundness',
-                'StandardDeviation', 'Minimum','Maximum']
-
-
-    dip_images, dip_names = load_dip_images('data/')
-    dip_images = normalize(dip_images)
-    save_images(dip_images, 'normalized', "data", file_type=["tif"])
-    dip_blue = make_grayscale(dip_images)
-    save_images(dip_blue, 'blues', "blue", file_type=["tif"])
-    print("Saved dip_blue")
-    dip_thresh = threshold_images(dip_blue)
-    save_images(dip_thresh, 'thresh', "thresh", file_type=["tif"])
-    print("Saved thresh")
-    dip_transf = apply_transformations(dip_thresh)
-    save_images(dip_transf, 'transf', "transf", file_type=["tif"])
-    print("Saved transf")
-    label_images, measurements = measure_elements(dip_transf,dip_blue, features)
-    areas, perimeters, circularity, roundness, stand_dev, minimum, maximum = measurements_array(measurements, features)
-    dip_transf = crop_images(dip_transf,minimum,maximum)
-    save_images(dip_transf, 'transf', "transf", file_type=["tif"])
-    print("Saved cropped transf")
-    dip_blue = crop_images(dip_blue,minimum,maximum)
-    save_images(dip_blue, 'blues', "blue", file_type=["tif"])
-    crop_original = crop_images(dip_images,minimum,maximum)
-    save_images(crop_original, 'crop_original', "crop_original", file_type=["tif"])
-    blue_areas, m_blues, blue_grays = blue_area(crop_original,features)
-    save_images(blue_areas, 'blue_areas', "blue_area", file_type=["tif"])
-    print("Saved blue_areas")
-    save_images(blue_grays, 'blue_grays', "blue_gray", file_type=["tif"])
-    label_images, measurements = measure_elements(dip_transf, dip_blue, features)
-    areas, perimeters, circularity, roundness, stand_dev, minimum, maximum = measurements_array(measurements, features)
-    areas_blue, perimeters_blue, circularity_blue, roundness_blue, std_blue, minimum_blue, maximum_blue = measurements_array(m_blues, features)
-    hog_embryo = hog_img(dip_transf, orientation = 8, pixels_per_cell=(16,64))
-    hog_blue = hog_img(blue_areas, orientation = 8, pixels_per_cell=(16,64))
-    print("Creating hog_blue")
-    save_images(hog_embryo, 'hog_embryos', "hog_embryos", file_type=["tif"])
-    save_images(hog_blue, 'hog_blues', "hog_blue", file_type=["tif"])
+def main(roi=False, writer=None, cache=None, hog_images=False):
+    """ Runs every stage of pipeline.py on data/, saving the results in
+        the current directory
+    """
+    run = Run('data/', '.', writer, cache=cache, roi=roi, 
+                hog_images=hog_images)
+    for command in ["segment", "measure", "hog"]:
+        run_stages(run, command)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--roi", action="store_true",
+                        help="run the Kuwahara filter only around the embryo; "
+                            "approximate, the threshold comes from the region "
+                            "histogram so the masks and measurements differ "
+                            "from a full run")
+    parser.add_argument("--writers", type=int, default=0,
+                        help="processes writing the images in the background, "
+                            "0 to write them synchronously")
+    parser.add_argument("--stack", action="store_true",
+                        help="save every directory of images as a single "
+                            "memory mappable stack file")
+    parser.add_argument("--hog-images", action="store_true",
+                        help="also save the HOG visualisations")
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of the stage cache, no cache if unset")
+    parser.add_argument("--cache-size", type=int, default=2048,
+                        help="size cap of the stage cache in MB")
+    parser.add_argument("--report", default=None,
+                        help="write a JSON report of the stages to this file")
+    parser.add_argument("--per-image", action="store_true",
+                        help="include the time of every image in the report")
+    args = parser.parse_args()
+    if args.report is not None:
+        instrument.enable(per_image=args.per_image)
+    writer = None
+    if args.stack:
+        writer = StackStore()
+    elif args.writers > 0:
+        writer = ImageWriter(workers=args.writers)
+    cache = None
+    if args.cache_dir is not None:
+        cache = StageCache(args.cache_dir, args.cache_size*1024**2)
+    main(roi=args.roi, writer=writer, cache=cache, hog_images=args.hog_images)
+    if writer is not None:
+        writer.close()
+    if args.report is not None:
+        instrument.write_report(args.report)
\ No newline at end of file
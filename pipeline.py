@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+import argparse
+# only light modules are imported here: every stage imports what it
+# needs, so that a short job (e.g. measure) does not pay for matplotlib,
+# skimage or sklearn
+
+
+FEATURES = ['Perimeter', 'Size', 'Circularity', 'Roundness',
+            'StandardDeviation', 'Minimum', 'Maximum']
+
+MEASUREMENT_COLUMNS = ['image', 'area', 'perimeter', 'circularity',
+                        'roundness', 'std', 'min_x', 'min_y', 'max_x', 'max_y']
+
+
+class Run:
+    """ State of a pipeline run. The images computed by the stages are
+        saved in output_dir and kept in memory for the next stages; an
+        image series no stage of this run computed is loaded from the
+        directory an earlier run saved it in, so that any range of
+        stages can be run on its own.
+
+        Params:
+            - input_dir: directory (or stack) of the original images
+            - output_dir: directory the results are saved in
+            - writer: optional ImageWriter or StackStore, see save_images
+            - workers, chunksize, cache: see parallel_map
+            - roi: run the Kuwahara filter only around the embryo, an
+                approximation: the threshold is computed on the region
+                histogram, not the frame one, so the masks and the
+                measurements differ from a full frame run
+            - hog_images: also save the HOG visualisations
+            - model: path of the classifier used by classify
+    """
+
+    def __init__(self, input_dir="data/", output_dir="transformed/",
+                    writer=None, workers=1, chunksize=1, cache=None,
+                    roi=False, hog_images=False, model="model.pkl"):
+        self.input_dir = input_dir
+        self.output_dir = output_dir
+        self.writer = writer
+        self.pool = dict(workers=workers, chunksize=chunksize, cache=cache)
+        self.roi = roi
+        self.hog_images = hog_images
+        self.model = model
+        self.images = {}
+
+    def path(self, name):
+        return os.path.join(self.output_dir, name)
+
+    def get(self, name):
+        """ Image series name, "original" being the input images
+        """
+        if name not in self.images:
+            from utilities import load_dip_images
+            import instrument
+            if name == "original":
+                images, names = load_dip_images(self.input_dir)
+                instrument.set_image_names(names)
+            else:
+                images, _ = load_dip_images(self.path(name))
+            if not images:
+                raise FileNotFoundError("no %s images, run the stage "
+                                        "computing them first" % name)
+            self.images[name] = images
+        return self.images[name]
+
+    def put(self, name, name_temp, images):
+        """ Saves the image series name and keeps it for the next stages
+        """
+        from utilities import save_images
+        save_images(images, self.path(name), name_temp, file_type=["tif"],
+                    writer=self.writer)
+        self.images[name] = images
+        print("Saved", name)
+
+
+def _normalize(run):
+    from utilities import normalize
+    run.put("normalized", "data", normalize(run.get("original"), **run.pool))
+
+def _grayscale(run):
+    from utilities import make_grayscale, make_grayscale_roi
+    normalized = run.get("normalized")
+    if run.roi:
+        # filter only around a coarse estimate of the embryo
+        blues, origins = make_grayscale_roi(normalized, **run.pool)
+        _write_csv(run.path("origins.csv"), ['image', 'x', 'y'],
+                    [[i, x, y] for i, (x, y) in enumerate(origins)])
+    else:
+        blues = make_grayscale(normalized, **run.pool)
+        if os.path.exists(run.path("origins.csv")):
+            os.remove(run.path("origins.csv"))
+    run.put("blues", "blue", blues)
+
+def _threshold(run):
+    from utilities import threshold_images
+    run.put("thresh", "thresh", threshold_images(run.get("blues"), **run.pool))
+
+def _transform(run):
+    from utilities import apply_transformations
+    run.put("transf", "transf",
+            apply_transformations(run.get("thresh"), **run.pool))
+
+def _measure(run):
+    from utilities import measure_elements, measurements_array
+    _, measurements = measure_elements(run.get("transf"), run.get("blues"),
+                                        FEATURES)
+    rows = _measurement_rows(measurements_array(measurements, FEATURES))
+    origins = _origins(run)
+    if origins is not None:
+        # bounding boxes in frame coordinates
+        for row, (x, y) in zip(rows, origins):
+            row[6:] = [row[6] + x, row[7] + y, row[8] + x, row[9] + y]
+    _write_csv(run.path("measurements.csv"), MEASUREMENT_COLUMNS, rows)
+    print("Saved measurements.csv")
+
+def _crop(run):
+    from utilities import crop_images
+    rows = _read_csv(run.path("measurements.csv"))
+    minimum = [[row['min_x'], row['min_y']] for row in rows]
+    maximum = [[row['max_x'], row['max_y']] for row in rows]
+    origins = _origins(run)
+    run.put("crop_transf", "transf", crop_images(run.get("transf"), minimum,
+                                                maximum, origins=origins))
+    run.put("crop_blues", "blue", crop_images(run.get("blues"), minimum,
+                                                maximum, origins=origins))
+    run.put("crop_original", "crop_original",
+            crop_images(run.get("normalized"), minimum, maximum))
+
+def _blue(run):
+    from utilities import blue_area, measurements_array
+    blue_areas, measurements, blue_grays = blue_area(run.get("crop_original"),
+                                                    FEATURES, **run.pool)
+    run.put("blue_areas", "blue_area", blue_areas)
+    run.put("blue_grays", "blue_gray", blue_grays)
+    _write_csv(run.path("blue_measurements.csv"), MEASUREMENT_COLUMNS,
+                _measurement_rows(measurements_array(measurements, FEATURES)))
+    print("Saved blue_measurements.csv")
+
+def _texture(run):
+    import numpy as np
+    from texture import texture_matrix
+    # texture of the blue area and of the rest of the embryo, see
+    # texture_columns
+    matrix = texture_matrix(run.get("crop_original"), run.get("crop_transf"),
+                            run.get("blue_areas"), **run.pool)
+    np.save(run.path("texture_features.npy"), matrix)
+    print("Saved texture_features", matrix.shape)
+
+def _hog(run):
+    import numpy as np
+    from utilities import hog_features, calculate_hog
+    transf, blue_areas = run.get("crop_transf"), run.get("blue_areas")
+    # descriptors of the whole embryo followed by the blue region
+    hog_matrix = hog_features(transf, blue_areas, orientations=8,
+                                pixels_per_cell=(16,64), **run.pool)
+    np.save(run.path("hog_features.npy"), hog_matrix)
+    print("Saved hog_features", hog_matrix.shape)
+    if run.hog_images:
+        run.put("hog_embryos", "hog_embryos",
+                calculate_hog(transf, orientation=8, pixels_per_cell=(16,64),
+                                rgb=False, visualize=True, **run.pool))
+        run.put("hog_blues", "hog_blue",
+                calculate_hog(blue_areas, orientation=8,
+                                pixels_per_cell=(16,64), rgb=False,
+                                visualize=True, **run.pool))
+
+def _classify(run):
+    from natsort import natsorted
+    from classifier import Classifier
+    filenames = [x for x in natsorted(os.listdir(run.input_dir))
+                    if ".tif" in x and x[-5] in "0123456789"]
+    # the position in the series chooses the threshold method
+    labels = Classifier.load(run.model).predict_images(
+        [os.path.join(run.input_dir, x) for x in filenames],
+        range(len(filenames)))
+    _write_csv(run.path("predictions.csv"), ['image', 'label'],
+                zip(filenames, labels))
+    print("Saved predictions.csv")
+
+
+# stages of every command, in the order they run
+COMMANDS = {
+    'segment': [("normalize", _normalize), ("grayscale", _grayscale),
+                ("threshold", _threshold), ("transform", _transform)],
+    'measure': [("measure", _measure), ("crop", _crop), ("blue", _blue),
+                ("texture", _texture)],
+    'hog': [("hog", _hog)],
+    'classify': [("classify", _classify)],
+}
+
+def select_stages(command, first=None, last=None):
+    """ Stages of command from first to last (included)
+        Returns:
+            - list of (name, function) tuples
+    """
+    stages = COMMANDS[command]
+    names = [name for name, _ in stages]
+    for name in [first, last]:
+        if name is not None and name not in names:
+            raise ValueError("%s has no stage %s, its stages are %s" %
+                                (command, name, ", ".join(names)))
+    start = names.index(first) if first is not None else 0
+    stop = names.index(last) + 1 if last is not None else len(names)
+    return stages[start:stop]
+
+def run_stages(run, command, first=None, last=None):
+    """ Runs the selected stages of command
+    """
+    os.makedirs(run.output_dir, exist_ok=True)
+    for name, func in select_stages(command, first, last):
+        start = time.perf_counter()
+        func(run)
+        print("Stage %s done in %.2fs" % (name, time.perf_counter() - start))
+
+def _measurement_rows(arrays):
+    areas, perimeters, circularity, roundness, std, minimum, maximum = arrays
+    return [[i, areas[i], perimeters[i], circularity[i], roundness[i], std[i],
+                minimum[i][0], minimum[i][1], maximum[i][0], maximum[i][1]]
+            for i in range(len(areas))]
+
+def _origins(run):
+    """ Frame position of the images of a --roi run, None otherwise
+    """
+    if not os.path.exists(run.path("origins.csv")):
+        return None
+    return [(row['x'], row['y']) for row in _read_csv(run.path("origins.csv"))]
+
+def _write_csv(path, columns, rows):
+    import csv
+    with open(path, "w", newline="") as f:
+        out = csv.writer(f)
+        out.writerow(columns)
+        out.writerows(rows)
+
+def _read_csv(path):
+    """ Rows of a csv file written by _write_csv, as dicts of numbers
+    """
+    import csv
+    with open(path, newline="") as f:
+        return [{key: float(value) for key, value in row.items()}
+                for row in csv.DictReader(f)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the stages of the "
+                                    "embryo pipeline")
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--input", default="data/",
+                        help="directory (or stack) of the original images")
+    common.add_argument("--output", default="transformed/",
+                        help="directory of the results, and of the results "
+                            "of earlier stages")
+    common.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    common.add_argument("--chunksize", type=int, default=1,
+                        help="images sent to a worker at once")
+    common.add_argument("--cache-dir", default=None,
+                        help="directory of the stage cache, no cache if unset")
+    common.add_argument("--cache-size", type=int, default=2048,
+                        help="size cap of the stage cache in MB")
+    common.add_argument("--writers", type=int, default=0,
+                        help="processes writing the images in the background, "
+                            "0 to write them synchronously")
+    common.add_argument("--stack", action="store_true",
+                        help="save every directory of images as a single "
+                            "memory mappable stack file")
+    common.add_argument("--report", default=None,
+                        help="write a JSON report of the stages to this file")
+    common.add_argument("--per-image", action="store_true",
+                        help="include the time of every image in the report")
+    sub = parser.add_subparsers(dest="command", required=True)
+    for command, stages in COMMANDS.items():
+        names = [name for name, _ in stages]
+        p = sub.add_parser(command, parents=[common],
+                            help="stages " + ", ".join(names))
+        p.add_argument("--from", dest="first", choices=names, default=None,
+                        help="first stage to run")
+        p.add_argument("--to", dest="last", choices=names, default=None,
+                        help="last stage to run")
+        if command == "segment":
+            p.add_argument("--roi", action="store_true",
+                            help="run the Kuwahara filter only around the "
+                                "embryo; approximate, the threshold comes "
+                                "from the region histogram so the masks "
+                                "and measurements differ from a full run")
+        if command == "hog":
+            p.add_argument("--hog-images", action="store_true",
+                            help="also save the HOG visualisations")
+        if command == "classify":
+            p.add_argument("--model", default="model.pkl")
+    args = parser.parse_args(argv)
+
+    if args.report is not None:
+        import instrument
+        instrument.enable(per_image=args.per_image)
+    writer = None
+    if args.stack:
+        from image_stack import StackStore
+        writer = StackStore()
+    elif args.writers > 0:
+        from image_writer import ImageWriter
+        writer = ImageWriter(workers=args.writers)
+    cache = None
+    if args.cache_dir is not None:
+        from stage_cache import StageCache
+        cache = StageCache(args.cache_dir, args.cache_size*1024**2)
+    run = Run(args.input, args.output, writer, args.workers or None,
+                args.chunksize, cache, roi=getattr(args, "roi", False),
+                hog_images=getattr(args, "hog_images", False),
+                model=getattr(args, "model", "model.pkl"))
+    try:
+        run_stages(run, args.command, args.first, args.last)
+    finally:
+        if writer is not None:
+            writer.close()
+    if args.report is not None:
+        instrument.write_report(args.report)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
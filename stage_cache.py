@@ -0,0 +1,241 @@
+import os
+import sys
+import hashlib
+import inspect
+import pickle
+import threading
+import numpy as np
+import diplib as dip
+import utilities
+from utilities import pack_images, unpack_images, MorphologyChain
+
+
+# bump to invalidate every entry after a change the keys do not see,
+# see StageCache
+CACHE_VERSION = 1
+
+
+class StageCache:
+    """ On-disk cache of stage outputs, keyed by a hash of the stage
+        function, its input images and its parameters.
+        Entries are evicted least recently used first once the cache
+        grows over max_bytes. The cache only holds a directory and a
+        size, so it can be shared by the worker processes.
+        The keys cover the source of the module of every stage function
+        and of utilities, where the helpers of the stages (check_dtype,
+        normalize_uint8, the morphology...) live, and the diplib
+        version. A change elsewhere, e.g. in another module a stage
+        calls, is not seen: bump CACHE_VERSION or clear the cache.
+
+        Params:
+            - cache_dir: directory where the entries are stored
+            - max_bytes: size cap of the cache directory
+    """
+
+    def __init__(self, cache_dir=".stage_cache", max_bytes=2*1024**3):
+        if cache_dir[-1] != "/":
+            cache_dir += "/"
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._size = None
+
+    def wrap(self, func):
+        """ Returns a cached version of the stage function func
+        """
+        return CachedStage(func, self)
+
+    def key(self, func, *args):
+        """ Hash of the stage func applied to args
+        """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(("%d %s" % (CACHE_VERSION, dip.__version__)).encode())
+        h.update(_module_digest(utilities))
+        _update_hash(h, func)
+        for arg in args:
+            _update_hash(h, arg)
+        return h.hexdigest()
+
+    def get(self, key):
+        """ Returns the cached value of key, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted meanwhile by another process or thread
+            pass
+        return unpack_images(value)
+
+    def put(self, key, value):
+        """ Stores value under key and evicts old entries if needed
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique per process and thread, both can store the same key
+        tmp = path + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as f:
+            pickle.dump(pack_images(value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        if self._size is None:
+            self._size = self.size()
+        else:
+            self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def size(self):
+        """ Total size in bytes of the cache directory
+        """
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target=0.9):
+        """ Removes least recently used entries until the cache is
+            below target times max_bytes
+        """
+        entries = sorted(self._entries(), key=lambda x: x[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= target*self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # already evicted by another process
+                pass
+            total -= size
+        self._size = total
+
+    def clear(self):
+        """ Removes every entry of the cache
+        """
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._size = 0
+
+    def _path(self, key):
+        return self.cache_dir + key[:2] + "/" + key + ".pkl"
+
+    def _entries(self):
+        """ (path, size, last use) of every entry
+        """
+        if not os.path.exists(self.cache_dir):
+            return []
+        entries = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if not entry.name.endswith(".pkl"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+
+class CachedStage:
+    """ Picklable wrapper of a stage function that looks its result
+        up in a StageCache before computing it.
+    """
+
+    def __init__(self, func, cache):
+        self.func = func
+        self.cache = cache
+
+    def __call__(self, *args):
+        key = self.cache.key(self.func, *args)
+        value = self.cache.get(key)
+        if value is None:
+            value = self.func(*args)
+            self.cache.put(key, value)
+        return value
+
+
+def _update_hash(h, obj):
+    """ Feeds obj to the hash h, hashing images by content and
+        functions by name, source (of the function and of its module),
+        default and bound parameters, so that editing a stage
+        invalidates its entries
+    """
+    if isinstance(obj, dip.Image):
+        arr = np.ascontiguousarray(obj)
+        h.update(b"img%d" % obj.TensorElements())
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(arr.data)
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        h.update(b"arr")
+        h.update(str((arr.dtype.str, arr.shape)).encode())
+        h.update(arr.data)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"seq%d" % len(obj))
+        for x in obj:
+            _update_hash(h, x)
+    elif hasattr(obj, "func") and hasattr(obj, "keywords"):
+        # functools.partial
+        h.update(b"partial")
+        _update_hash(h, obj.func)
+        _update_hash(h, obj.args)
+        for name, value in sorted(obj.keywords.items()):
+            h.update(name.encode())
+            _update_hash(h, value)
+    elif isinstance(obj, MorphologyChain):
+        h.update(b"morphology")
+        h.update(repr(obj.steps).encode())
+        _update_hash(h, obj.se)
+    elif callable(obj):
+        h.update(("%s.%s" % (obj.__module__, obj.__qualname__)).encode())
+        h.update(_source_digest(obj))
+        # the helpers it calls in its module
+        h.update(_module_digest(sys.modules.get(obj.__module__)))
+        # parameters left to their defaults, e.g. filter sizes
+        _update_hash(h, getattr(obj, "__defaults__", None) or ())
+        for name, value in sorted((getattr(obj, "__kwdefaults__", None)
+                                    or {}).items()):
+            h.update(name.encode())
+            _update_hash(h, value)
+    else:
+        h.update(repr(obj).encode())
+
+_SOURCE_DIGESTS = {}
+_MODULE_DIGESTS = {}
+
+def _module_digest(module):
+    """ Hash of the source file of module, empty when it has none
+    """
+    path = getattr(module, "__file__", None)
+    if path is None:
+        return b""
+    if path not in _MODULE_DIGESTS:
+        try:
+            with open(path, "rb") as f:
+                source = f.read()
+        except OSError:
+            source = b""
+        _MODULE_DIGESTS[path] = hashlib.blake2b(source, digest_size=16).digest()
+    return _MODULE_DIGESTS[path]
+
+def _source_digest(func):
+    """ Hash of the source code of func, empty for builtins
+    """
+    code = getattr(func, "__code__", None)
+    if code is None:
+        return b""
+    if code not in _SOURCE_DIGESTS:
+        try:
+            source = inspect.getsource(func).encode()
+        except (OSError, TypeError):
+            source = code.co_code
+        _SOURCE_DIGESTS[code] = hashlib.blake2b(source, digest_size=16).digest()
+    return _SOURCE_DIGESTS[code]
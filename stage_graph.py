@@ -0,0 +1,159 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import instrument
+
+
+class StageGraph:
+    """ Graph of stages declaring their inputs. Running it computes
+        every needed stage exactly once, runs stages that do not depend
+        on each other concurrently and drops every intermediate result
+        as soon as its last consumer has finished.
+        Concurrent stages run in threads: the diplib and numpy work
+        releases the GIL, the images are shared instead of copied to
+        worker processes, and the stages record their instrumentation
+        in this process. The stages parallelise their images with
+        their own process pools, see parallel_map.
+
+        Example:
+            graph = StageGraph()
+            graph.add("gray", make_grayscale, "orig")
+            graph.add("thresh", threshold_images, "gray")
+            graph.run(orig=images)["thresh"]
+    """
+
+    def __init__(self):
+        self.nodes = {}
+
+    def add(self, name, func, *inputs, local=False, **params):
+        """ Adds the stage name computing func(*inputs, **params)
+            Input:
+                - name: name of the stage, must be unique
+                - func: function of the stage. Unless local it is run
+                    in a worker thread when the graph runs with several
+                    workers, so it must be thread safe
+                - inputs: names of the stages (or of the values given
+                    to run) whose results are the arguments of func
+                - local: always run func in the calling thread, for
+                    stages using objects that are not thread safe
+                    (e.g. an ImageWriter) or too cheap to be worth it
+                - params: constant keyword arguments of func
+            Returns:
+                - name, to be used as input of other stages
+        """
+        if name in self.nodes:
+            raise ValueError("stage %s already defined" % name)
+        self.nodes[name] = _Node(name, func, inputs, params, local)
+        return name
+
+    def run(self, targets=None, workers=1, **values):
+        """ Computes the stages needed for targets
+            Input:
+                - targets: names of the stages whose results are
+                    returned, defaults to the stages nothing depends on
+                - workers: number of stages computed at the same time
+                    in worker threads, with 1 every stage is computed
+                    in the calling thread
+                - values: values of the inputs that are not stages
+            Returns:
+                - dict target name -> result
+        """
+        if targets is None:
+            consumed = {x for node in self.nodes.values() for x in node.inputs}
+            targets = [name for name in self.nodes if name not in consumed]
+        order = self._order(targets, values)
+        # number of stages still to run that need each result
+        consumers = dict.fromkeys(values, 0)
+        consumers.update(dict.fromkeys(order, 0))
+        for name in order:
+            for x in self.nodes[name].inputs:
+                consumers[x] += 1
+        # the given values are only held by results from now on, so
+        # that they are released after their last consumer too
+        results = dict(values)
+        values.clear()
+        if workers == 1:
+            for name in order:
+                with instrument.stage(name):
+                    results[name] = self.nodes[name].call(results)
+                self._release(name, results, consumers, targets)
+        else:
+            self._run_parallel(order, results, consumers, targets, workers)
+        return {name: results[name] for name in targets}
+
+    def _run_parallel(self, order, results, consumers, targets, workers):
+        waiting = list(order)
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while waiting or running:
+                for name in [x for x in waiting if self._ready(x, results)]:
+                    node = self.nodes[name]
+                    waiting.remove(name)
+                    if node.local:
+                        with instrument.stage(name):
+                            results[name] = node.call(results)
+                        self._release(name, results, consumers, targets)
+                        continue
+                    running[pool.submit(_run_node, node,
+                                        node.args(results))] = name
+                if not running:
+                    # local stages made new stages ready
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    self._release(name, results, consumers, targets)
+
+    def _ready(self, name, results):
+        return all(x in results for x in self.nodes[name].inputs)
+
+    def _release(self, name, results, consumers, targets):
+        """ Drops the inputs of name that no other stage needs
+        """
+        for x in self.nodes[name].inputs:
+            consumers[x] -= 1
+            if consumers[x] == 0 and x not in targets:
+                del results[x]
+        if consumers[name] == 0 and name not in targets:
+            del results[name]
+
+    def _order(self, targets, values):
+        """ Stages needed by targets, in a topological order
+        """
+        order, visiting = [], set()
+        def visit(name):
+            if name in values or name in order:
+                return
+            if name not in self.nodes:
+                raise KeyError("no stage or value named %s" % name)
+            if name in visiting:
+                raise ValueError("cycle through stage %s" % name)
+            visiting.add(name)
+            for x in self.nodes[name].inputs:
+                visit(x)
+            visiting.remove(name)
+            order.append(name)
+        for name in targets:
+            visit(name)
+        return order
+
+
+class _Node:
+    def __init__(self, name, func, inputs, params, local):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.params = params
+        self.local = local
+
+    def args(self, results):
+        return [results[x] for x in self.inputs]
+
+    def call(self, results):
+        return self.func(*self.args(results), **self.params)
+
+
+def _run_node(node, args):
+    # the arguments are taken by the scheduling thread, the only one
+    # touching the results
+    with instrument.stage(node.name):
+        return node.func(*args, **node.params)
@@ -0,0 +1,201 @@
+from functools import partial
+import numpy as np
+from utilities import parallel_imap, instrumented
+
+
+# regions of region_labels, 0 being the background
+REGIONS = ("rest", "blue")
+
+# gray levels of the co-occurrence matrices
+LEVELS = 32
+
+# pixel offsets (rows, columns) of the co-occurrence matrices: the four
+# directions at distance 1, the matrices being symmetric
+OFFSETS = ((0, 1), (1, 1), (1, 0), (1, -1))
+
+# neighbours of the local binary patterns, in circular order
+LBP_NEIGHBOURS = ((-1, -1), (-1, 0), (-1, 1), (0, 1),
+                    (1, 1), (1, 0), (1, -1), (0, -1))
+
+FIRST_ORDER = ["mean", "std", "uniformity", "entropy"]
+COOCCURRENCE = ["contrast", "homogeneity", "energy", "correlation",
+                "glcm_entropy"]
+LBP_BINS = len(LBP_NEIGHBOURS) + 2
+
+
+def _lbp_lut():
+    """ Rotation invariant uniform pattern of every 8 bit code: the
+        number of set bits for the codes with at most two 0/1
+        transitions around the circle, LBP_BINS-1 for the others
+    """
+    codes = np.arange(256)
+    bits = (codes[:, None] >> np.arange(8)) & 1
+    transitions = np.sum(bits != np.roll(bits, 1, axis=1), axis=1)
+    return np.where(transitions <= 2, bits.sum(axis=1),
+                    LBP_BINS - 1).astype(np.intp)
+
+_LBP_LUT = _lbp_lut()
+
+def texture_columns(regions=REGIONS):
+    """ Names of the values of texture_features, region by region
+    """
+    names = FIRST_ORDER + COOCCURRENCE + \
+            ["lbp%d" % i for i in range(LBP_BINS)]
+    return [region + "_" + name for region in regions for name in names]
+
+def texture_gray(img):
+    """ uint8 gray image the texture is measured on: scalar images are
+        kept, color ones are averaged over their channels
+    """
+    arr = np.asarray(img)
+    if arr.dtype != np.uint8:
+        raise TypeError("texture needs a uint8 image, not %s" % arr.dtype)
+    if arr.ndim == 3:
+        arr = np.round(arr.mean(axis=2)).astype(np.uint8)
+    return arr
+
+def region_labels(embryo_mask, blue_mask):
+    """ Label image of the regions: 1 for the embryo outside the blue
+        area, 2 for the blue area of the embryo, 0 elsewhere
+    """
+    embryo = np.asarray(embryo_mask, dtype=bool)
+    blue = np.asarray(blue_mask, dtype=bool) & embryo
+    return embryo.astype(np.intp) + blue
+
+def lbp_codes(gray):
+    """ Rotation invariant uniform local binary pattern of every pixel,
+        from its 8 neighbours at distance 1 (the image edge being
+        repeated), in [0, LBP_BINS)
+    """
+    gray = np.asarray(gray)
+    padded = np.pad(gray, 1, mode="edge")
+    rows, cols = gray.shape
+    codes = np.zeros(gray.shape, np.uint8)
+    for bit, (dy, dx) in enumerate(LBP_NEIGHBOURS):
+        neighbour = padded[1+dy:1+dy+rows, 1+dx:1+dx+cols]
+        codes |= (neighbour >= gray).astype(np.uint8) << bit
+    return _LBP_LUT[codes]
+
+def _first_order(gray, labels, n):
+    counts = np.bincount(labels.ravel(), minlength=n+1)[1:].astype(float)
+    values = gray.ravel().astype(float)
+    sums = np.bincount(labels.ravel(), weights=values, minlength=n+1)[1:]
+    squares = np.bincount(labels.ravel(), weights=values**2,
+                            minlength=n+1)[1:]
+    hist = np.bincount(labels.ravel()*256 + gray.ravel(),
+                        minlength=(n+1)*256).reshape(n+1, 256)[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = sums / counts
+        std = np.sqrt(np.maximum(squares / counts - mean**2, 0))
+        p = hist / counts[:, None]
+    return np.stack([mean, std, np.sum(p**2, axis=1), _entropy(p)], axis=1)
+
+def _cooccurrence(gray, labels, n, levels, offsets):
+    """ Properties of the symmetric co-occurrence matrix of every
+        region, summed over the offsets, from the pairs of pixels that
+        both lie in the region
+    """
+    q = (gray.astype(np.intp) * levels) >> 8
+    rows, cols = gray.shape
+    glcm = np.zeros(n*levels*levels)
+    for dy, dx in offsets:
+        a = (slice(0, rows-dy), slice(max(0, -dx), cols-max(0, dx)))
+        b = (slice(dy, rows), slice(max(0, dx), cols-max(0, -dx)))
+        la, lb = labels[a], labels[b]
+        same = (la == lb) & (la > 0)
+        index = ((la[same]-1)*levels + q[a][same])*levels + q[b][same]
+        glcm += np.bincount(index, minlength=n*levels*levels)
+    glcm = glcm.reshape(n, levels, levels)
+    glcm += glcm.transpose(0, 2, 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        p = glcm / glcm.sum(axis=(1, 2))[:, None, None]
+        i, j = np.indices((levels, levels))
+        contrast = np.sum(p*(i-j)**2, axis=(1, 2))
+        homogeneity = np.sum(p/(1.0+(i-j)**2), axis=(1, 2))
+        energy = np.sqrt(np.sum(p**2, axis=(1, 2)))
+        # symmetric matrices: both marginals are the same
+        mu = np.sum(p*i, axis=(1, 2))
+        var = np.sum(p*(i-mu[:, None, None])**2, axis=(1, 2))
+        covariance = np.sum(p*(i-mu[:, None, None])*(j-mu[:, None, None]),
+                            axis=(1, 2))
+        # constant regions are perfectly correlated, as in skimage
+        correlation = np.where(var > 1e-15, covariance/var, 1.0)
+        correlation[np.isnan(mu)] = np.nan
+    return np.stack([contrast, homogeneity, energy, correlation,
+                        _entropy(p.reshape(n, -1))], axis=1)
+
+def _lbp_histogram(gray, labels, n):
+    codes = lbp_codes(gray)
+    hist = np.bincount(labels.ravel()*LBP_BINS + codes.ravel(),
+                        minlength=(n+1)*LBP_BINS).reshape(n+1, LBP_BINS)[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return hist / hist.sum(axis=1, keepdims=True)
+
+def _entropy(p):
+    """ Entropy in bits of every row of probabilities p
+    """
+    logs = np.log2(p, out=np.zeros_like(p), where=p > 0)
+    return -np.sum(p*logs, axis=1)
+
+def region_texture(gray, labels, n_regions=len(REGIONS), levels=LEVELS,
+                    offsets=OFFSETS):
+    """ Texture of every region of a label image, every statistic being
+        a single label indexed bincount over the image
+        Input:
+            - gray: uint8 gray image (array or diplib image)
+            - labels: int array of the same shape, 0 for the background
+                and 1..n_regions for the regions
+            - levels: gray levels of the co-occurrence matrices, the
+                gray values being quantised to levels bins
+            - offsets: (rows, columns) offsets of the co-occurrence
+                matrices
+        Returns:
+            - (n_regions, n_features) float64 array with the first order
+                statistics (mean, std, uniformity and entropy of the
+                256 bins histogram), the co-occurrence properties and
+                the normalised LBP histogram; the values of empty
+                regions (e.g. embryos without blue area) are 0, so that
+                the classifier can use every row
+    """
+    gray = texture_gray(gray)
+    labels = np.asarray(labels, dtype=np.intp)
+    if labels.shape != gray.shape:
+        raise ValueError("labels of shape %s for an image of shape %s" %
+                            (labels.shape, gray.shape))
+    features = np.hstack([_first_order(gray, labels, n_regions),
+                            _cooccurrence(gray, labels, n_regions, levels,
+                                            offsets),
+                            _lbp_histogram(gray, labels, n_regions)])
+    return np.nan_to_num(features, copy=False, nan=0.0)
+
+def texture_features(gray, embryo_mask, blue_mask, levels=LEVELS):
+    """ Texture of the blue area and of the rest of the embryo
+        Returns:
+            - float64 vector, named by texture_columns
+    """
+    labels = region_labels(embryo_mask, blue_mask)
+    return region_texture(gray, labels, len(REGIONS), levels).ravel()
+
+@instrumented()
+def texture_matrix(grays: list, embryo_masks: list, blue_masks: list,
+                    levels=LEVELS, workers=1, chunksize=1, cache=None):
+    """ Texture feature matrix of a series of embryos, as input of the
+        classifier
+        Input:
+            - grays: python list with the uint8 images, see texture_gray
+            - embryo_masks, blue_masks: masks of every image
+            - levels: see region_texture
+            - workers, chunksize, cache: see parallel_map
+        Returns:
+            - contiguous float64 array (n_images, n_features), its
+                columns named by texture_columns
+    """
+    func = partial(texture_features, levels=levels)
+    features = np.empty((len(grays), len(texture_columns())))
+    for i, row in enumerate(parallel_imap(func, grays, embryo_masks,
+                                            blue_masks, workers=workers,
+                                            chunksize=chunksize,
+                                            cache=cache)):
+        features[i] = row
+    return features
+
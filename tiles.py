@@ -0,0 +1,426 @@
+import argparse
+from functools import partial
+import numpy as np
+import diplib as dip
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from utilities import (parallel_imap, grayscale_image, kuwahara_halo,
+                        threshold_method, EMBRYO_MORPHOLOGY, MorphologyChain)
+from image_stack import ImageStack, StackWriter
+from instrument import instrumented
+
+
+# Large acquisitions (e.g. mosaics of many embryos) are processed in
+# bands of rows spanning the whole image width, so that the memory used
+# by a stage is bounded by the size of a band and not of the image.
+# Bands rather than square tiles: diplib accumulates some filters (e.g.
+# Kuwahara) in float32 along the image lines, so lines must keep their
+# start to give bit identical results (see roi_filter), and labels only
+# have to be stitched across one kind of seam.
+# Images are numpy arrays (rows, columns[, channels]), possibly memory
+# mapped (see image_stack), and outputs can be given as memory mapped
+# arrays as well (np.lib.format.open_memmap).
+TILE_ROWS = 1024
+
+
+def tile_bounds(rows, tile_rows=TILE_ROWS, halo=0):
+    """ Bands covering rows rows
+        Input:
+            - rows: number of rows of the image
+            - tile_rows: rows of a band, without its halo
+            - halo: rows of context added on both sides of a band
+        Returns:
+            - list of (lo, hi, core_lo, core_hi): the band holds rows
+                lo:hi of the image, and its rows core_lo:core_hi are
+                the image rows lo+core_lo:lo+core_hi it computes
+    """
+    bounds = []
+    for start in range(0, rows, tile_rows):
+        stop = min(rows, start + tile_rows)
+        lo, hi = max(0, start - halo), min(rows, stop + halo)
+        bounds.append((lo, hi, start - lo, stop - lo))
+    return bounds
+
+def _tiles(arr, bounds):
+    for lo, hi, _, _ in bounds:
+        yield np.ascontiguousarray(arr[lo:hi])
+
+def _apply_tile(func, tile, core_lo, core_hi):
+    """ Applies the per image function func to a band and keeps its core
+    """
+    tensor = tile.ndim - 1 if tile.ndim == 3 else None
+    out = np.asarray(func(dip.Image(tile, tensor)))
+    return np.ascontiguousarray(out[core_lo:core_hi])
+
+def _output(out, rows, first):
+    """ out, allocated after the first band if None
+    """
+    if out is None:
+        out = np.empty((rows,) + first.shape[1:], first.dtype)
+    return out
+
+@instrumented()
+def tiled_filter(arr, func, halo, tile_rows=TILE_ROWS, out=None, workers=1):
+    """ Applies a per image function band by band, giving the result of
+        func on the whole image
+        Input:
+            - arr: image as a numpy array
+            - func: module level function of a diplib image (e.g.
+                grayscale_image) returning an image of the same size
+            - halo: support radius of func, e.g. kuwahara_halo(10) or
+                MorphologyChain.halo()
+            - tile_rows: rows of a band
+            - out: optional array receiving the result
+            - workers: processes filtering the bands, see parallel_imap
+        Returns:
+            - out, or a new array holding the result
+    """
+    bounds = tile_bounds(len(arr), tile_rows, halo)
+    results = parallel_imap(partial(_apply_tile, func), _tiles(arr, bounds),
+                            [b[2] for b in bounds], [b[3] for b in bounds],
+                            workers=workers)
+    for (lo, _, core_lo, core_hi), result in zip(bounds, results):
+        out = _output(out, len(arr), result)
+        out[lo+core_lo:lo+core_hi] = result
+    return out
+
+def _percentile_rank(percentile, n):
+    """ Rank of the value dip.Percentile returns among n sorted values,
+        rounding half ranks away from the closest end
+    """
+    if percentile <= 50:
+        return int(np.floor(percentile/100*(n-1) + 0.5))
+    return n-1 - int(np.floor((100-percentile)/100*(n-1) + 0.5))
+
+def _rank_value(arr, rank, low, high, tile_rows=TILE_ROWS, bins=4096,
+                limit=1<<20):
+    """ Exact value of the given rank among the sorted values of arr,
+        without sorting (or loading) arr: the range holding the value
+        is narrowed by histograms of the bands until it holds few
+        enough values, whose distinct values are then counted
+        Input:
+            - low, high: minimum and maximum of arr
+    """
+    below = 0
+    for _ in range(4):
+        edges = np.linspace(low, high, bins + 1)
+        counts = np.zeros(bins, np.int64)
+        for tile in _tiles(arr, tile_bounds(len(arr), tile_rows)):
+            values = tile[(tile >= low) & (tile <= high)]
+            idx = np.clip(np.searchsorted(edges, values, "right") - 1, 
+                            0, bins - 1)
+            counts += np.bincount(idx, minlength=bins)
+        if counts.sum() <= limit:
+            break
+        cumulative = below + np.cumsum(counts)
+        k = int(np.searchsorted(cumulative, rank, "right"))
+        below = int(cumulative[k] - counts[k])
+        # every bin but the last excludes its upper edge
+        low = edges[k]
+        high = edges[k+1]
+        if k < bins - 1:
+            high = np.nextafter(high, -np.inf)
+    distinct, counts = [], []
+    for tile in _tiles(arr, tile_bounds(len(arr), tile_rows)):
+        values, n = np.unique(tile[(tile >= low) & (tile <= high)],
+                                return_counts=True)
+        distinct.append(values)
+        counts.append(n)
+    values, inverse = np.unique(np.concatenate(distinct), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate(counts))
+    k = int(np.searchsorted(below + np.cumsum(counts), rank, "right"))
+    return values[k]
+
+def histogram_configuration(arr, tile_rows=TILE_ROWS):
+    """ Configuration of the histogram diplib thresholds the whole image
+        with (dip.Histogram.OptimalConfiguration), found band by band:
+        a Freedman-Diaconis bin size, computed from the exact quartiles,
+        and limits excluding the outliers. Bins of integer images have
+        an integer size.
+    """
+    low, high = None, None
+    for tile in _tiles(arr, tile_bounds(len(arr), tile_rows)):
+        low = tile.min() if low is None else min(low, tile.min())
+        high = tile.max() if high is None else max(high, tile.max())
+    n = arr.size
+    q1, q3 = [float(_rank_value(arr, _percentile_rank(p, n), low, high,
+                                tile_rows)) for p in [25, 75]]
+    iqr = q3 - q1
+    low, high = float(low), float(high)
+    if iqr > 0:
+        low, high = max(low, q1 - 50*iqr), min(high, q3 + 50*iqr)
+    if arr.dtype.kind == "f":
+        if iqr > 0:
+            bins = max(1, int(np.floor((high - low)/(2*iqr/np.cbrt(n)) + 0.5)))
+        else:
+            bins = 256
+        # diplib moves the upper bound so that it includes the maximum
+        size = (high*(1 + 1e-15) - low)/bins
+    else:
+        values = high - low + 1
+        if iqr > 0:
+            size = max(1, int(np.ceil(2*iqr/np.cbrt(n))))
+        else:
+            size = max(1, int(np.ceil(values/256)))
+        bins = max(1, int(np.floor(values/size + 0.5)))
+    configuration = dip.Histogram.Configuration(low, bins, float(size))
+    configuration.excludeOutOfBoundValues = True
+    return configuration
+
+def tiled_histogram(arr, tile_rows=TILE_ROWS):
+    """ diplib histogram of a scalar image, accumulated band by band
+    """
+    configuration = [histogram_configuration(arr, tile_rows)]
+    histogram = None
+    for tile in _tiles(arr, tile_bounds(len(arr), tile_rows)):
+        h = dip.Histogram(dip.Image(tile), configuration=configuration)
+        if histogram is None:
+            histogram = h
+        else:
+            histogram += h
+    return histogram
+
+def _fixed_threshold(img, threshold):
+    return dip.FixedThreshold(img, threshold)
+
+@instrumented()
+def tiled_threshold(arr, method="otsu", tile_rows=TILE_ROWS, out=None,
+                    workers=1):
+    """ Tiled threshold_image: the threshold is found on the histogram
+        of the whole image, accumulated band by band, and then applied
+        to every band
+        Returns:
+            - the binary image (out, or a new bool array) and the
+                threshold
+    """
+    histogram = tiled_histogram(arr, tile_rows)
+    if method == "triangle":
+        threshold = dip.TriangleThreshold(histogram)
+    else:
+        threshold = dip.OtsuThreshold(histogram)
+    func = partial(_fixed_threshold, threshold=threshold)
+    return tiled_filter(arr, func, 0, tile_rows, out, workers), threshold
+
+def _connectivity(connectivity, ndim=2):
+    # diplib's 0 is the full connectivity
+    return connectivity or ndim
+
+def _label_tile(tile, connectivity):
+    """ Labels of a band and what stitching needs: its first and last
+        row and the labels touching its left and right edges
+    """
+    labels = np.asarray(dip.Label(dip.Image(tile), connectivity=connectivity),
+                        dtype=np.uint32)
+    n = int(labels.max()) if labels.size else 0
+    edges = np.unique(np.concatenate([labels[:, 0], labels[:, -1]]))
+    return labels, n, labels[0].copy(), labels[-1].copy(), edges
+
+def _summary_tile(tile, connectivity):
+    # same as _label_tile without the labels, for callers that do not
+    # keep them
+    return _label_tile(tile, connectivity)[1:]
+
+def _seam_pairs(last, first, offset_last, offset_first, connectivity):
+    """ Pairs of provisional labels meeting across the seam between the
+        last row of a band and the first row of the next one
+    """
+    shifts = [0] if connectivity == 1 else [-1, 0, 1]
+    pairs = []
+    width = len(last)
+    for s in shifts:
+        a = last[max(0, -s):width - max(0, s)]
+        b = first[max(0, s):width - max(0, -s)]
+        both = (a > 0) & (b > 0)
+        pairs.append(np.stack([a[both].astype(np.int64) + offset_last,
+                                b[both].astype(np.int64) + offset_first]))
+    return np.concatenate(pairs, axis=1)
+
+def _stitch(summaries, connectivity):
+    """ Global labels of the provisional labels of every band
+        Input:
+            - summaries: (n, first row, last row, edge labels) of every
+                band, see _label_tile
+        Returns:
+            - lut: global label of every provisional label, numbered
+                as dip.Label numbers the labels of the whole image (in
+                the order of their first pixel)
+            - offsets: provisional label of the label 0 of every band
+            - number of global labels
+    """
+    offsets = np.cumsum([0] + [x[0] for x in summaries])
+    total = int(offsets[-1])
+    pairs = [np.empty((2, 0), np.int64)]
+    for i in range(len(summaries) - 1):
+        pairs.append(_seam_pairs(summaries[i][2], summaries[i+1][1],
+                                    offsets[i], offsets[i+1], connectivity))
+    pairs = np.concatenate(pairs, axis=1)
+    graph = coo_matrix((np.ones(pairs.shape[1], np.int8), pairs),
+                        shape=(total + 1, total + 1))
+    _, component = connected_components(graph, directed=False)
+    # provisional labels follow the raster order of their first pixel,
+    # so the smallest of a component gives the order of its first pixel
+    first = np.full(component.max() + 1, total + 1)
+    np.minimum.at(first, component, np.arange(total + 1))
+    rank = np.empty_like(first)
+    rank[np.argsort(first)] = np.arange(len(first))
+    # component of the label 0 (the background) has rank 0
+    lut = rank[component].astype(np.uint32)
+    return lut, offsets, len(first) - 1
+
+def _band_lut(lut, offset, n):
+    return np.concatenate([[0], lut[offset+1:offset+n+1]]).astype(np.uint32)
+
+@instrumented()
+def tiled_label(mask, connectivity=1, tile_rows=TILE_ROWS, out=None,
+                workers=1):
+    """ Tiled dip.Label: every band is labelled on its own, the labels
+        meeting across the seams are merged and numbered as dip.Label
+        numbers the objects of the whole image
+        Input:
+            - mask: binary image as a bool array
+            - connectivity: as in dip.Label
+            - out: optional uint32 array receiving the labels
+        Returns:
+            - the labels (out, or a new uint32 array) and their number
+    """
+    connectivity = _connectivity(connectivity, mask.ndim)
+    bounds = tile_bounds(len(mask), tile_rows)
+    if out is None:
+        out = np.empty(mask.shape, np.uint32)
+    summaries = []
+    for (lo, hi, _, _), result in zip(bounds, parallel_imap(
+            partial(_label_tile, connectivity=connectivity),
+            _tiles(mask, bounds), workers=workers)):
+        out[lo:hi] = result[0]
+        summaries.append(result[1:])
+    lut, offsets, n = _stitch(summaries, connectivity)
+    for i, (lo, hi, _, _) in enumerate(bounds):
+        out[lo:hi] = _band_lut(lut, offsets[i], summaries[i][0])[out[lo:hi]]
+    return out, n
+
+def _fill_tile(tile, border, connectivity):
+    """ Fills the background components of a band, but the ones whose
+        label is marked in border (touching the image border)
+    """
+    labels = _label_tile(~tile, connectivity)[0]
+    return tile | ~border[labels]
+
+@instrumented()
+def tiled_fill_holes(mask, connectivity=1, tile_rows=TILE_ROWS, out=None,
+                        workers=1):
+    """ Tiled dip.FillHoles: the holes are the background components
+        not touching the image border. The background is labelled band
+        by band twice, first to stitch its components and then to fill
+        them, so that no image sized label array is kept.
+        Returns:
+            - out, or a new bool array with the holes filled
+    """
+    # as dip.FillHoles, connectivity is the one of the background
+    connectivity = _connectivity(connectivity, mask.ndim)
+    bounds = tile_bounds(len(mask), tile_rows)
+    summaries = list(parallel_imap(partial(_summary_tile,
+                                            connectivity=connectivity),
+                                    (~tile for tile in _tiles(mask, bounds)),
+                                    workers=workers))
+    lut, offsets, n = _stitch(summaries, connectivity)
+    border = np.zeros(n + 1, bool)
+    for i, (count, first, last, edges) in enumerate(summaries):
+        band = _band_lut(lut, offsets[i], count)
+        border[band[edges]] = True
+        if i == 0:
+            border[band[first]] = True
+        if i == len(summaries) - 1:
+            border[band[last]] = True
+    border[0] = False
+    # border marks of the labels of every band
+    luts = [border[_band_lut(lut, offsets[i], x[0])]
+            for i, x in enumerate(summaries)]
+    results = parallel_imap(partial(_fill_tile, connectivity=connectivity),
+                            _tiles(mask, bounds), luts, workers=workers)
+    for (lo, hi, _, _), result in zip(bounds, results):
+        out = _output(out, len(mask), result)
+        out[lo:hi] = result
+    return out
+
+def _chain(steps, chain):
+    # sub chain running some of the (already collapsed) steps of chain
+    sub = MorphologyChain([], chain.se, chain.se_size)
+    sub.steps = steps
+    return sub
+
+@instrumented()
+def tiled_morphology(mask, chain=EMBRYO_MORPHOLOGY, tile_rows=TILE_ROWS,
+                        out=None, workers=1):
+    """ Tiled MorphologyChain: runs of local steps are filtered band by
+        band with the halo of the run, fill_holes with tiled_fill_holes
+        Returns:
+            - out, or a new bool array with the result of chain
+    """
+    runs, run = [], []
+    for step in chain.steps:
+        if step[0] == "fill_holes":
+            if run:
+                runs.append(run)
+            runs.append(step)
+            run = []
+        else:
+            run.append(step)
+    if run or not runs:
+        runs.append(run)
+    for i, run in enumerate(runs):
+        target = out if i == len(runs) - 1 else None
+        if isinstance(run, tuple):
+            mask = tiled_fill_holes(mask, 1, tile_rows, target, workers)
+        else:
+            sub = _chain(run, chain)
+            mask = tiled_filter(mask, sub, sub.halo(), tile_rows, target,
+                                workers)
+    return mask
+
+@instrumented()
+def segment_mosaic(arr, method="otsu", tile_rows=TILE_ROWS, workers=1):
+    """ Embryos of a large acquisition, as grayscale_image,
+        threshold_image, transform_image and dip.Label of the whole
+        image, computed band by band
+        Input:
+            - arr: color image as a (rows, columns, 3) array
+            - method: threshold method, see threshold_method
+        Returns:
+            - the labels of the embryos (uint32 array) and their number
+    """
+    gray = tiled_filter(arr, grayscale_image, kuwahara_halo(10), tile_rows,
+                        workers=workers)
+    thresh, _ = tiled_threshold(gray, method, tile_rows, workers=workers)
+    del gray
+    transf = tiled_morphology(thresh, EMBRYO_MORPHOLOGY, tile_rows,
+                                workers=workers)
+    del thresh
+    return tiled_label(transf, 1, tile_rows, workers=workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Labels the embryos of "
+                                    "large acquisitions band by band")
+    parser.add_argument("path", help="tif image, or image stack")
+    parser.add_argument("output", help="stack receiving the labels")
+    parser.add_argument("--tile-rows", type=int, default=TILE_ROWS)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    args = parser.parse_args()
+
+    if args.path.endswith(".stack"):
+        stack = ImageStack(args.path)
+        # memory mapped, read band by band by segment_mosaic
+        images = ((stack.names[i], stack.array(i)) for i in range(len(stack)))
+    else:
+        images = iter([(args.path, np.asarray(dip.ImageReadTIFF(args.path)))])
+    # every label image is written as soon as it is computed, so that
+    # only one is in memory at a time
+    with StackWriter(args.output) as out:
+        for index, (name, arr) in enumerate(images):
+            labels, n = segment_mosaic(arr, threshold_method(index),
+                                        tile_rows=args.tile_rows,
+                                        workers=args.workers or None)
+            print("%s: %d objects" % (name, n))
+            out.append(labels, name)
+            del labels
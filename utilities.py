@@ -1,16 +1,54 @@
-from copy import deepcopy
 import os
+import sys
+import time
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import numpy as np
 import diplib as dip
-import matplotlib.pyplot as plt
-from skimage.io import imread
-from skimage.feature import hog
-import matplotlib.pyplot as plt
-from natsort import natsorted
-from PIL import Image
+# skimage, PIL and natsort are imported by the functions using them,
+# so that the stages which do not need them start fast
+import instrument
+from instrument import instrumented
+from image_stack import StackStore, is_stack, iter_stack, stack_path
+
+def iter_dip_images(images_dir):
+    """ Lazily loads the tif images of directory, one at a time,
+        in natsorted order.
+        Input:
+            - images_dir: string containing the path
+                of the directory of the image series, or of a stack
+                file. A directory saved as a stack (see StackStore)
+                is read from its stack.
+        Yields:
+            - (dip_image, filename) tuples
+    """
+    if not os.path.isdir(images_dir) and \
+            is_stack(stack_path(images_dir)):
+        images_dir = stack_path(images_dir)
+    if is_stack(images_dir):
+        yield from iter_stack(images_dir)
+        return
+    from natsort import natsorted
+    # check that directory is defined correctly
+    if images_dir[-1] != "/":
+        images_dir += "/"
+    for filename in natsorted(os.listdir(images_dir)):
+        if ".tif" in filename:
+            if filename[-5] not in [str(x) for x in range(0,10)]:
+                continue
+            with instrument.stage("read_image", 1) as stage:
+                img = dip.ImageReadTIFF(images_dir+filename)
+                if instrument.enabled():
+                    # libtiff maps the file, procfs does not see it
+                    stage.read_bytes = os.path.getsize(images_dir+filename)
+            yield img, filename
 
 def load_dip_images(images_dir):
-    """ Will only load the tif images of directory.
+    """ Will only load the tif images of directory (or its stack).
         Input:
             - images_dir: string containing the path
                 of the directory of the image series
@@ -18,21 +56,17 @@ def load_dip_images(images_dir):
             - dip_images: list of loaded dip images
             - img_names: list of filenames
     """
-    # check that directory is defined correctly
-    if images_dir[-1] != "/":
-        images_dir += "/"
     # load all .tif images
     dip_images = []
     img_names = []
-    for filename in natsorted(os.listdir(images_dir)):
-        if ".tif" in filename:
-            if filename[-5] not in [str(x) for x in range(0,10)]:
-                continue
-            dip_images.append(dip.ImageReadTIFF(images_dir+filename))
-            img_names.append(filename)
+    for img, filename in iter_dip_images(images_dir):
+        dip_images.append(img)
+        img_names.append(filename)
     return dip_images, img_names
 
-def save_images(dip_images, images_dir, name_temp="", file_type="tif"):
+@instrumented()
+def save_images(dip_images, images_dir, name_temp="", file_type="tif", 
+                writer=None):
     """ Saves the imput images
         Input:
             - dip_images: python list with the images to save
@@ -40,92 +74,476 @@ def save_images(dip_images, images_dir, name_temp="", file_type="tif"):
             - name_temp: string containing the name structure 
                         to give to the series of images
             - file_type: can be string or list of file types to save image
+            - writer: optional ImageWriter writing the images in the
+                background, or StackStore saving the directory as a
+                single stack file, otherwise they are written here
     """
 
+    images_dir, name_temp = _prepare_save(images_dir, name_temp, 
+                                        not isinstance(writer, StackStore))
+    # save images loop
+    counter = 0
+    for img in dip_images:
+        _save(img, images_dir+name_temp+str(counter), file_type, writer)
+        counter += 1
+
+@instrumented()
+def save_image(img, images_dir, name_temp="", index=0, file_type="tif", 
+                writer=None):
+    """ Saves a single image with the same naming scheme as save_images,
+        so that images can be written out as soon as they are computed.
+        Input:
+            - img: diplib image to save
+            - images_dir: string with the directory to save the image
+            - name_temp: string containing the name structure 
+                        to give to the series of images
+            - index: position of the image in the series
+            - file_type: can be string or list of file types to save image
+            - writer: optional ImageWriter or StackStore, see save_images
+    """
+    images_dir, name_temp = _prepare_save(images_dir, name_temp, 
+                                        not isinstance(writer, StackStore))
+    _save(img, images_dir+name_temp+str(index), file_type, writer)
+
+# extension added by diplib for every supported file type
+FILE_EXTENSIONS = {"tif": ".tif", "jpeg": ".jpg"}
+
+def _save(img, path, file_type, writer):
+    if isinstance(writer, StackStore):
+        # a stack holds the pixels, once for all the formats
+        writer.write(img, path, _file_types(file_type))
+        return
+    for curr_type in _file_types(file_type):
+        if writer is not None:
+            writer.write(img, path, curr_type)
+        else:
+            write_image_file(img, path, curr_type)
+
+def _file_types(file_type):
+    """ Supported file types in file_type, a string or a list
+    """
+    return [x for x in FILE_EXTENSIONS if x in file_type]
+
+def write_image_file(img, path, file_type="tif"):
+    """ Writes img to path (without extension) in a single format
+        Returns:
+            - the path of the written file
+    """
+    if file_type == "tif":
+        dip.ImageWriteTIFF(img, path)
+    elif file_type == "jpeg":
+        # if the image is binary we need to multiply by 255
+        if img.DataType() == "BIN":
+            img = dip.Image(np.asarray(img).astype(np.uint8)*255)
+        dip.ImageWriteJPEG(img, path, 100)
+    else:
+        raise ValueError("unsupported file type " + str(file_type))
+    return path + FILE_EXTENSIONS[file_type]
+
+def image_digest(img):
+    """ Hash of the content (pixels, type and shape) of a dip image
+    """
+    arr = np.ascontiguousarray(img)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str((arr.dtype.str, arr.shape, img.TensorElements())).encode())
+    h.update(arr.data)
+    return h.hexdigest()
+
+def _prepare_save(images_dir, name_temp, create=True):
+    """ Normalizes the directory and name template used to save
+        images and creates the directory if needed.
+    """
     # check that path is correctly defined
     if images_dir[-1] != "/":
         images_dir += "/"
     # create directories if needed
-    if not os.path.exists(images_dir):
-        os.makedirs(images_dir)
+    if create and not os.path.exists(images_dir):
+        os.makedirs(images_dir, exist_ok=True)
     # check name
     if name_temp != "" and name_temp[-1] != "-":
         name_temp += "-"
-    # save images loop
-    counter = 0
-    for img in dip_images:
-        if  "tif" in file_type:
-            dip.ImageWriteTIFF(img,images_dir+name_temp+str(counter))
-        if "jpeg" in file_type:
-            # if the image is binary we need to multiply by 255
-            if img.DataType() == "BIN":
-                img = img * 255
-            # save jpg image
-            dip.ImageWriteJPEG(img,images_dir+name_temp+str(counter), 100)
-            exit()
-        counter += 1
+    return images_dir, name_temp
 
-def normalize_resize(dip_images:list, new_size=(323,256), normalize=True):
-    new_images = []
+def parallel_imap(func, *iterables, workers=None, chunksize=1, cache=None):
+    """ Lazily applies func to the items of iterables in a pool of
+        worker processes. Results are yielded in input order and at
+        most two chunks per worker are in flight, so long image series
+        are never fully loaded in memory.
+        diplib objects can not be pickled, so dip images are sent to
+        and from the workers as numpy arrays. func must be a module
+        level function (or a functools.partial of one).
+        Input:
+            - func: per-image function to apply
+            - iterables: one iterable per positional argument of func
+            - workers: number of processes, defaults to the cpu count.
+                With 1 worker func runs in the calling process.
+            - chunksize: number of items sent to a worker at once
+            - cache: optional StageCache, results already in the cache
+                are loaded instead of computed
+        Yields:
+            - results of func, in the order of the inputs
+        When per image instrumentation is enabled the time spent on
+        every item is recorded under the name of func.
+    """
+    name = _func_name(func)
+    timed = instrument.per_image()
+    if cache is not None:
+        func = cache.wrap(func)
+    items = zip(*iterables)
+    if workers == 1:
+        for index, args in enumerate(items):
+            if not timed:
+                yield func(*args)
+                continue
+            start = time.perf_counter()
+            result = func(*args)
+            instrument.record_image(name, index, time.perf_counter()-start)
+            yield result
+        return
+    if workers is None:
+        workers = os.cpu_count()
+    pending = deque()
+    submitted = 0
+    with ProcessPoolExecutor(max_workers=workers, 
+                            initializer=_init_worker) as pool:
+        while True:
+            chunk = list(islice(items, chunksize))
+            if not chunk:
+                break
+            future = pool.submit(_run_chunk, func, pack_images(chunk))
+            pending.append((submitted, future))
+            submitted += len(chunk)
+            if len(pending) >= 2*workers:
+                yield from _chunk_results(pending.popleft(), name, timed)
+        while pending:
+            yield from _chunk_results(pending.popleft(), name, timed)
 
-    for i in range(len(dip_images)):
-        arr = np.array(dip_images[i])
-        max = 65535
-        min = 0
-        if normalize == True:
-            arr = (((arr - min) / (max - min))*255).astype(np.uint8)
-        rescaled = Image.fromarray(arr).resize(new_size)
-        new_images.append(dip.Image(np.array(rescaled)))
-    return new_images
+def parallel_map(func, *iterables, workers=None, chunksize=1, cache=None):
+    """ List version of parallel_imap
+    """
+    return list(parallel_imap(func, *iterables, workers=workers, 
+                                chunksize=chunksize, cache=cache))
+
+def _init_worker():
+    # one diplib thread per process, the pool provides the parallelism
+    dip.SetNumberOfThreads(1)
+
+def _run_chunk(func, chunk):
+    results, durations = [], []
+    for args in unpack_images(chunk):
+        start = time.perf_counter()
+        results.append(func(*args))
+        durations.append(time.perf_counter() - start)
+    return pack_images(results), durations
+
+def _chunk_results(pending, name, timed):
+    first, future = pending
+    results, durations = future.result()
+    if timed:
+        for i in range(len(durations)):
+            instrument.record_image(name, first+i, durations[i])
+    return unpack_images(results)
+
+def _func_name(func):
+    while hasattr(func, "func"):
+        # functools.partial or cached stage
+        func = func.func
+    return getattr(func, "__name__", repr(func))
+
+class _PackedImage:
+    """ Picklable stand-in for a dip image, binary images being packed
+        to a bit per pixel
+    """
+    def __init__(self, img):
+        self.array = np.asarray(img)
+        self.tensor = img.TensorElements() > 1
+        self.shape = None
+        if self.array.dtype == bool:
+            self.shape = self.array.shape
+            self.array = np.packbits(self.array, axis=None)
+
+    def unpack(self):
+        array = self.array
+        # images packed before binary images were bit packed have no shape
+        shape = getattr(self, "shape", None)
+        if shape is not None:
+            array = np.unpackbits(array, count=int(np.prod(shape)))
+            array = array.reshape(shape).view(bool)
+        if self.tensor:
+            return dip.Image(array, array.ndim-1)
+        return dip.Image(array, None)
+
+def pack_images(obj):
+    """ Replaces the dip images in obj (possibly nested in lists and
+        tuples) with picklable numpy based stand-ins
+    """
+    if isinstance(obj, dip.Image):
+        return _PackedImage(obj)
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(pack_images(x) for x in obj)
+    return obj
+
+def unpack_images(obj):
+    """ Inverse of pack_images
+    """
+    if isinstance(obj, _PackedImage):
+        return obj.unpack()
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(unpack_images(x) for x in obj)
+    return obj
+
+def check_dtype(img, *data_types):
+    """ Checks the data type of an image at a stage boundary, so that
+        an unexpected (e.g. float64) image fails early instead of
+        silently multiplying the memory used by the next stages.
+        Input:
+            - img: diplib image
+            - data_types: accepted diplib data types, e.g. "UINT8"
+        Returns:
+            - img
+    """
+    if str(img.DataType()) not in data_types:
+        raise TypeError("expected a %s image, got %s" % 
+                        (" or ".join(data_types), img.DataType()))
+    return img
+
+# uint16 -> uint8 normalisation of normalize_resize_image as a lookup
+# table, built with the float formula so that the results are the same
+_NORMALIZE_LUT = ((np.arange(65536) / 65535)*255).astype(np.uint8)
+
+def normalize_uint8(arr):
+    """ Normalizes the values of arr, in [0, 65535], to uint8.
+        uint16 arrays go through a lookup table, other types are
+        scaled in place in their own float precision.
+    """
+    if arr.dtype == np.uint16:
+        return _NORMALIZE_LUT[arr]
+    scaled = arr / 65535
+    scaled *= 255
+    return scaled.astype(np.uint8)
+
+def normalize_resize_image(img, new_size=(323,256), normalize=True):
+    """ Normalizes a single uint16 image to uint8 and resizes it.
+    """
+    from PIL import Image
+    arr = np.asarray(img)
+    if normalize == True:
+        arr = normalize_uint8(arr)
+    rescaled = Image.fromarray(arr).resize(new_size)
+    out = dip.Image(np.array(rescaled))
+    return check_dtype(out, "UINT8") if normalize else out
+
+@instrumented()
+def normalize_resize(dip_images:list, new_size=(323,256), normalize=True,
+                        workers=1, chunksize=1, cache=None):
+    func = partial(normalize_resize_image, new_size=new_size, 
+                    normalize=normalize)
+    return parallel_map(func, dip_images, workers=workers, 
+                        chunksize=chunksize, cache=cache)
+
+def normalize_image(img):
+    """ Normalizes a single uint16 image to uint8, keeping its size
+        and channels.
+    """
+    arr = normalize_uint8(np.asarray(img))
+    out = dip.Image(arr, 2 if img.TensorElements() > 1 else None)
+    return check_dtype(out, "UINT8")
 
-def make_grayscale(dip_images: list):
+@instrumented()
+def normalize(dip_images: list, workers=1, chunksize=1, cache=None):
+    """ Normalizes the uint16 images to uint8 at their original size
+    """
+    return parallel_map(normalize_image, dip_images, workers=workers, 
+                        chunksize=chunksize, cache=cache)
+
+def grayscale_image(img, kernel=10, threshold=10):
+    """ Smooths a single image and keeps its blue channel
+        Input:
+            - kernel, threshold: parameters of dip.Kuwahara
+    """
+    kuwahara = dip.Kuwahara(img, kernel, threshold)
+    array= np.array(kuwahara)
+    return dip.Image(array[:,:,2])
+
+@instrumented()
+def make_grayscale(dip_images: list, workers=1, chunksize=1, cache=None):
     """ Converts the diplip images to grayscale
     """
-    blues = []
-    grays = []
-    for img in dip_images:
-        kuwahara = dip.Kuwahara(img, 10,10)
-        array= np.array(kuwahara)
-        blue_img = dip.Image(array[:,:,2])
-        blues.append(blue_img)
-    return blues
+    return parallel_map(grayscale_image, dip_images, workers=workers, 
+                        chunksize=chunksize, cache=cache)
+
+def invert_image(img, out=None):
+    """ Inverts a single binary image
+        Input:
+            - out: optional image receiving the result, img itself to
+                invert it in place
+    """
+    check_dtype(img, "BIN")
+    if out is None:
+        return dip.Invert(img)
+    dip.Invert(img, out=out)
+    return out
 
-def invert_colors(dip_images: list):
+@instrumented()
+def invert_colors(dip_images: list, inplace=False):
     new_images = []
-    print(len(dip_images))
     for img in dip_images:
-        new_img = np.array(img) == False
-        new_images.append(dip.Image(new_img))
+        new_images.append(invert_image(img, img if inplace else None))
     return new_images
 
-def blue_area(dip_images: list,features):
+def mask_image(img, *masks, out=None):
+    """ Sets to 0 the pixels of img that are 0 in any of the masks.
+        Every mask is applied in one vectorised pass (the channels of
+        color images sharing the mask), without coordinate arrays or
+        combined masks.
+        Input:
+            - img: diplib image or numpy array
+            - masks: binary masks with the sizes of img, combined
+                with AND (e.g. the embryo mask and the blue mask)
+            - out: optional numpy array with the shape and dtype of
+                img receiving the result, np.asarray(img) to mask
+                img in place
+        Returns:
+            - diplib image of the result, sharing the memory of out
+    """
+    arr = np.asarray(img)
+    if out is None:
+        out = np.empty_like(arr)
+    _mask_array(arr, masks, out)
+    return _array_image(out, arr.ndim > np.ndim(masks[0]) if masks else False)
+
+@instrumented()
+def mask_images(dip_images, *masks, out=None, inplace=False):
+    """ Applies mask_image to a series of images
+        Input:
+            - dip_images: list of diplib images, or array whose first
+                axis is the image (e.g. ImageStack.as_array()), masked
+                in a single pass
+            - masks: one or more lists (or arrays) of masks, one per
+                image, combined with AND
+            - out: optional array of shape (images,) + image shape
+                reused for the results, allocated once if None and
+                the images have the same shape and dtype
+            - inplace: mask the images themselves
+        Returns:
+            - list of masked diplib images
+    """
+    if isinstance(dip_images, np.ndarray) and \
+            all(isinstance(m, np.ndarray) for m in masks):
+        # whole stack at once
+        if inplace:
+            out = dip_images
+        elif out is None:
+            out = np.empty_like(dip_images)
+        _mask_array(dip_images, masks, out)
+        tensor = dip_images.ndim > masks[0].ndim if masks else False
+        return [_array_image(x, tensor) for x in out]
+    if inplace:
+        return [mask_image(img, *[m[i] for m in masks], out=np.asarray(img))
+                for i, img in enumerate(dip_images)]
+    if out is None and len(dip_images) > 0:
+        first = np.asarray(dip_images[0])
+        if all(np.asarray(x).shape == first.shape and
+                np.asarray(x).dtype == first.dtype for x in dip_images):
+            out = np.empty((len(dip_images),) + first.shape, first.dtype)
+    return [mask_image(img, *[m[i] for m in masks],
+                        out=out[i] if out is not None else None)
+            for i, img in enumerate(dip_images)]
+
+def _mask_array(arr, masks, out):
+    """ out = arr with 0 where any of masks is 0, masks broadcasting
+        over the trailing channel axis of arr
+    """
+    if not masks:
+        np.copyto(out, arr)
+    src = arr
+    for mask in masks:
+        mask = np.asarray(mask)
+        if mask.dtype != bool:
+            mask = mask != 0
+        if arr.ndim > mask.ndim:
+            mask = mask[..., None]
+        if out.dtype.kind in "fc":
+            # multiplying would turn NaN into NaN and -x into -0.0
+            if src is not out:
+                np.copyto(out, src)
+            np.copyto(out, 0, where=~mask)
+        else:
+            np.multiply(src, mask, out=out)
+        src = out
+    return out
+
+def _array_image(arr, tensor):
+    """ diplib image sharing the memory of arr, its last axis being
+        the channels if tensor
+    """
+    return dip.Image(arr, arr.ndim-1 if tensor else None)
+
+def blue_mask_image(img, sigmas=(20,20), morphology=None):
+    """ Thresholds the gene expression of a single image.
+        Input:
+            - sigmas: sigmas of the Gauss smoothing
+            - morphology: MorphologyChain cleaning the mask,
+                BLUE_MORPHOLOGY if None
+        Returns:
+            - blue area mask and the gray image
+    """
+    if morphology is None:
+        morphology = BLUE_MORPHOLOGY
+    # only the first channel is used, the others are never converted
+    unit8 = dip.Convert(img(0), "UINT8")
+    gray = dip.Gauss(unit8,sigmas=list(sigmas))
+    thresh = morphology(dip.OtsuThreshold(gray))
+    return invert_image(thresh, out=thresh), gray
+
+def blue_area_image(img, features):
+    """ Extracts the gene expression of a single image.
+        Returns:
+            - blue area mask, its measurements and the gray image
+    """
+    blue, gray = blue_mask_image(img)
+    return (blue,) + _measure_blue(blue, gray, features)
+
+def _measure_blue(blue, gray, features):
+    label = dip.Label(blue, connectivity=1)
+    m = dip.MeasurementTool.Measure(label, gray, features = features)
+    return m, gray
+
+@instrumented()
+def blue_area(dip_images: list,features, workers=1, chunksize=1, cache=None):
     """ Converts the diplip images to unit8 and threshold them to extract the gene expression
+        The filtering runs on workers processes, the measurements
+        (which can not leave their process) are made here.
     """
     grays = []
     blue_areas = []
     m =[]
-    for img in dip_images:
-        unit8 = dip.Convert(img, "UINT8")
-        gauss = dip.Gauss(unit8,sigmas=[20,20])
-        x = np.array(gauss)
-        gray = x[:,:,0]
-        grays.append(dip.Image(gray))
-        thresh = dip.OtsuThreshold(gray)
-        thresh = dip.Opening(thresh)
-        thresh = dip.Closing(thresh)
-        thresh = dip.Erosion(thresh)
-        thresh = dip.Dilation(thresh)
-        # thresh = dip.FillHoles(thresh)
-        arr = np.array(thresh)
-        inverted = 1 - arr
-        inverted = ~ arr
-        label = dip.Label(dip.Image(inverted), connectivity=1)
-        blue_areas.append(dip.Image(inverted))
-        m.append(dip.MeasurementTool.Measure(label, dip.Image(gray), features = features))
+    # the chain is bound, so that the cache keys depend on its steps
+    func = partial(blue_mask_image, morphology=BLUE_MORPHOLOGY)
+    for blue, gray in parallel_imap(func, dip_images, 
+                                    workers=workers, chunksize=chunksize,
+                                    cache=cache):
+        mes, gray = _measure_blue(blue, gray, features)
+        grays.append(gray)
+        blue_areas.append(blue)
+        m.append(mes)
     return blue_areas, m, grays
 
+def threshold_method(index):
+    """ Threshold method used for the image at position index
+        of the natsorted series.
+    """
+    return "triangle" if index > 25 else "otsu"
+
+def threshold_image(img, method="otsu"):
+    """ Thresholds a single grayscale image with the given method
+    """
+    if method == "triangle":
+        return dip.TriangleThreshold(img)
+    return dip.OtsuThreshold(img)
 
-def threshold_images(dip_images):
+@instrumented()
+def threshold_images(dip_images, workers=1, chunksize=1, cache=None):
     """ Triangle threshold all the dip_images in the list.
         The images will be converted to grayscale if 
         not already grayscale.
@@ -134,140 +552,528 @@ def threshold_images(dip_images):
             dip_images: list of grayscale diplib images to threshold
             save: string of dir to save output images.
                 Images only saved if dir is specified.
+            workers, chunksize, cache: process pool and stage cache
+                settings, see parallel_imap
         Return:
             list of the thresholded images
     """
-    images_thresh = []
-    counter = 0
-    for img in dip_images:
-        if counter > 25:
-            curr_img = dip.TriangleThreshold(img)
-        else:    
-            curr_img = dip.OtsuThreshold(img)
-        images_thresh.append(curr_img)
-        counter += 1
-    return images_thresh
+    methods = [threshold_method(i) for i in range(len(dip_images))]
+    return parallel_map(threshold_image, dip_images, methods, 
+                        workers=workers, chunksize=chunksize, cache=cache)
+
+class MorphologyChain:
+    """ Sequence of morphological operations applied to binary images
+        without allocating the intermediate images: the steps write
+        alternately into a scratch image, kept from one image to the
+        next, and into the output image, which is the only image
+        allocated per image. Every thread has its own scratch image,
+        so that a chain can be shared by threads.
+        An erosion followed by a dilation (or a dilation followed by
+        an erosion) is run as a single opening (closing), with the
+        boundary condition the separate steps use so the result is
+        the same, and repeated idempotent steps are run once.
+
+        Params:
+            - steps: names of the operations, among "opening",
+                "closing", "erosion", "dilation" and "fill_holes"
+            - se: structuring element, diplib's default (a disk with
+                a diameter of 7 pixels) if None
+            - se_size: diameter of se in pixels, only needed by halo
+                with a custom se
+    """
+
+    def __init__(self, steps, se=None, se_size=None):
+        self.se = se
+        self.se_size = 7 if se is None else se_size
+        self.steps = _collapse_steps(steps)
+        self._local = threading.local()
+
+    def __call__(self, img, out=None):
+        """ Applies the chain to img
+            Input:
+                - img: binary diplib image, left untouched
+                - out: optional image reused for the result
+            Returns:
+                - out, or a new image holding the result
+        """
+        if out is None:
+            out = dip.Image()
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            scratch = self._local.scratch = dip.Image()
+        # the last step has to write into out
+        buffers = [out, scratch]
+        src = img
+        for i, step in enumerate(self.steps):
+            dst = buffers[(len(self.steps)-1-i) % 2]
+            self._apply(step, src, dst)
+            src = dst
+        if not self.steps:
+            out.Copy(img)
+        return out
+
+    def batch(self, dip_images: list):
+        """ Applies the chain to every image of dip_images
+        """
+        return [self(img) for img in dip_images]
+
+    def halo(self):
+        """ Distance in pixels up to which the input affects an output
+            pixel, i.e. the overlap tiles need to give the result of
+            the whole image
+        """
+        if self.se_size is None:
+            raise ValueError("the halo of a custom se needs its se_size")
+        radius = int(np.ceil(self.se_size/2))
+        halo = 0
+        for name, _ in self.steps:
+            if name == "fill_holes":
+                raise ValueError("fill_holes depends on the whole image")
+            halo += 2*radius if name in ["opening", "closing"] else radius
+        return halo
+
+    def _apply(self, step, src, dst):
+        name, boundary = step
+        if name == "fill_holes":
+            dip.FillHoles(src, out=dst)
+            return
+        func = {"opening": dip.Opening, "closing": dip.Closing, 
+                "erosion": dip.Erosion, "dilation": dip.Dilation}[name]
+        if self.se is None:
+            func(src, out=dst, boundaryCondition=boundary)
+        else:
+            func(src, out=dst, se=self.se, boundaryCondition=boundary)
+
+    def __getstate__(self):
+        # the scratch images are per thread and can not be pickled
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
 
-def apply_transformations(dip_images: list):
+# steps that give the same result when applied twice
+_IDEMPOTENT = ["opening", "closing", "fill_holes"]
+# pairs of steps run as a single one
+_FUSED = {("erosion", "dilation"): "opening", 
+          ("dilation", "erosion"): "closing"}
+
+def _collapse_steps(steps):
+    """ (name, boundary condition) of the steps actually run
+    """
+    collapsed = []
+    i = 0
+    while i < len(steps):
+        if tuple(steps[i:i+2]) in _FUSED:
+            # the separate steps extend the image by mirroring, while
+            # opening and closing extend it with the neutral value
+            step = (_FUSED[tuple(steps[i:i+2])], ["mirror"])
+            i += 2
+        elif steps[i] in _IDEMPOTENT + ["erosion", "dilation"]:
+            step = (steps[i], [])
+            i += 1
+        else:
+            raise ValueError("unknown morphological operation " + steps[i])
+        if step[0] in _IDEMPOTENT and collapsed and collapsed[-1] == step:
+            continue
+        collapsed.append(step)
+    return collapsed
+
+# opening to remove white pixel noise, closing to fill dark holes,
+# erosion to remove boundary pixels and dilation to extend object
+# boundary to background
+BLUE_MORPHOLOGY = MorphologyChain(["opening", "closing", 
+                                    "erosion", "dilation"])
+# same, then close any hole in the image
+EMBRYO_MORPHOLOGY = MorphologyChain(["opening", "closing", 
+                                    "erosion", "dilation", "fill_holes"])
+
+def transform_image(img, morphology=EMBRYO_MORPHOLOGY):
+    """ Applies the defined transform to a single diplib image
+    """
+    return morphology(check_dtype(img, "BIN"))
+
+@instrumented()
+def apply_transformations(dip_images: list, workers=1, chunksize=1, cache=None):
     """ Applies the defined transform to the dip_images
         Input:
             - dip_images: python list of diplib images
+            - workers, chunksize, cache: process pool and stage cache
+                settings, see parallel_imap
         Return:
             - out_images: python list with the transformed diplib images 
     """
-    out_images = dip_images.copy()
-    for i in range(len(out_images)):
-        # opening to remove white pixel noise
-        out_images[i] = dip.Opening(out_images[i])
-        # closing to fill dark holes:
-        out_images[i] = dip.Closing(out_images[i])
-        # erosion to remove boundary pixels
-        out_images[i] = dip.Erosion(out_images[i])
-        # out_images[i] = dip.Erosion(out_images[i])
-        # dilation to extend object boundary to background
-        out_images[i] = dip.Dilation(out_images[i])
-        # close any hole in the image
-        # opening to remove white pixel noise
-        # out_images[i] = dip.Opening(out_images[i])
-        out_images[i] = dip.FillHoles(out_images[i])
-    return out_images
+    return parallel_map(transform_image, dip_images, workers=workers, 
+                        chunksize=chunksize, cache=cache)
 
+@instrumented()
 def measure_elements(dip_to_measure: list, dip_grayscale: list, 
                     features):
     label_images=[]
     measurements = []
     for i in range(len(dip_to_measure)):
-        curr_img = dip.Label(dip_to_measure[i], connectivity=1)
-
-        measurements.append(dip.MeasurementTool.Measure(curr_img, 
-                                dip_grayscale[i], 
-                                features))
+        curr_img, curr_mes = measure_image(dip_to_measure[i], 
+                                            dip_grayscale[i], 
+                                            features)
+        measurements.append(curr_mes)
         label_images.append(curr_img)
 
     return label_images, measurements
 
-def parse_features(measurements):
-    """ Transforms the measurements object in numpy arrays
+def measure_image(to_measure, grayscale, features):
+    """ Labels a single binary image and measures its objects
+        Returns:
+            - labeled image and its measurements
     """
-    features = []
-    for mes in measurements:
-        curr_features = []
-        for i in range(mes.NumberOfFeatures()):
-            curr_feature = mes.Features()[i].name
-            curr_feats = []
-
-            for j in range(1, mes.NumberOfObjects()+1):
-                curr_elem = mes[curr_feature][j]
-                curr_feats.append(np.vstack(curr_elem))
-            curr_feats = np.hstack(curr_feats)    
-            curr_features.append(np.vstack(curr_feats))
-        curr_features = np.vstack(curr_features).T
-        features.append(curr_features)
-    return features
+    curr_img = dip.Label(to_measure, connectivity=1)
+    return curr_img, dip.MeasurementTool.Measure(curr_img, 
+                                                grayscale, 
+                                                features)
 
-def measurements_array(measurements, features):
+def measurement_table(measurement):
+    """ Converts a diplib measurement in a single numpy array in bulk,
+        without looping over the objects.
+        Input:
+            - measurement: output of dip.MeasurementTool.Measure
+        Returns:
+            - values: (objects, values) float array, one row per object
+            - columns: list with the name of every column, the feature
+                name for single valued features and feature_value
+                (e.g. Minimum_dim0) for the others. 
+                pd.DataFrame(values, columns=columns) gives a table.
+    """
+    values = np.array(measurement, dtype=float).reshape(
+                measurement.NumberOfObjects(), measurement.NumberOfValues())
+    value_names = [x.name for x in measurement.Values()]
+    columns = []
+    start = 0
+    for feature in measurement.Features():
+        n_values = feature.numberValues
+        if n_values == 1:
+            columns.append(feature.name)
+        else:
+            for k in range(n_values):
+                columns.append(feature.name + "_" + 
+                                (value_names[start+k] or str(k)))
+        start += n_values
+    return values, columns
 
-    areas, perimeters, circularity, roundness, stand_dev  = [],[], [], [] , [] 
-    
-    test = []
-    for i in range(len(measurements)):
-        area, perimeter, circ, round, stds  = [], [] , [] , [] , [] 
+def feature_columns(columns, feature):
+    """ Indices of the columns of measurement_table belonging to feature
+    """
+    return [i for i in range(len(columns)) 
+                if columns[i] == feature or columns[i].startswith(feature+"_")]
 
-        for j in range(1,measurements[i].NumberOfObjects()+1):
+def largest_object(values, columns, size_feature="Size"):
+    """ Row of measurement_table of the biggest object
+    """
+    return np.argmax(values[:, columns.index(size_feature)])
 
-            area.append(measurements[i][features[1]][j][0]) 
-            perimeter.append(measurements[i][features[0]][j][0])
-            circ.append(measurements[i][features[2]][j][0])
-            round.append(measurements[i][features[3]][j][0])
-            stds.append(measurements[i][features[4]][j][0])
+def parse_features(measurements):
+    """ Transforms the measurements object in numpy arrays
+    """
+    return [measurement_table(mes)[0] for mes in measurements]
 
-        
-        test.append(area)
-        idx = np.argmax(area)
-        areas.append(area[idx])
-        perimeters.append(perimeter[idx])
-        circularity.append(circ[idx])
-        roundness.append(round[idx])
-        stand_dev.append(stds[idx])
+@instrumented()
+def measurements_array(measurements, features):
+    """ Values of the biggest object of every image, the size being
+        features[1].
+        Input:
+            - measurements: list of diplib measurements
+            - features: list of the measured features, in the order
+                perimeter, size, circularity, roundness, 
+                standard deviation, followed by any other feature
+        Returns:
+            - one list per feature with a value per image: areas, 
+                perimeters, circularity, roundness, standard deviation 
+                and then the other features in the order given (e.g.
+                minimum and maximum). Features with more than one value
+                give an array per image.
+    """
+    order = [i for i in [1, 0, 2, 3, 4] if i < len(features)]
+    order += list(range(5, len(features)))
+    outputs = [[] for _ in order]
+    for mes in measurements:
+        values, columns = measurement_table(mes)
+        idx = largest_object(values, columns, features[1])
+        for out, feature in zip(outputs, order):
+            cols = feature_columns(columns, features[feature])
+            row = values[idx, cols]
+            out.append(row[0] if len(cols) == 1 else row)
+    return tuple(outputs)
 
+def crop_image(img, minimum, maximum, img_shape=None, off=5, 
+                origin=(0,0)):
+    """ Crops a single image to the bounding box given by minimum
+        and maximum, padded by off pixels when it fits in img_shape.
+        origin is the position in the frame of the first pixel of img,
+        for images only covering a region of interest of the frame.
+        img_shape defaults to the extent of img in the frame, so that
+        any acquisition size (e.g. tiles of a mosaic) can be cropped.
+    """
+    if img_shape is None:
+        img_shape = [int(o) + s for o, s in zip(origin, img.Sizes())]
+    # max boundary pixels
+    x_max_padding = int(maximum[0])
+    y_max_padding = int(maximum[1])
+    # min boudary pixels
+    x_min_padding = int(minimum[0])
+    y_min_padding = int(minimum[1])
 
-    return areas, perimeters, circularity, roundness, stand_dev
+    # the slices include their end, so the padded box fits only if its
+    # last pixel is below img_shape: with > a box ending on the frame
+    # edge raised an index out of range instead of being cropped
+    # without padding
+    if x_max_padding+off >= img_shape[0] or y_max_padding+off >= img_shape[1] or \
+        x_min_padding-off < 0 or y_min_padding-off < 0 :
+        off = 0
+    x0, y0 = int(origin[0]), int(origin[1])
+    return dip.Image.At(img, 
+                        slice(x_min_padding-off-x0,x_max_padding+off-x0), 
+                        slice(y_min_padding-off-y0,y_max_padding+off-y0))
 
-def crop_images(dip_images: list, minimum, maximum, img_shape=(1300,1030), off=5):
+@instrumented()
+def crop_images(dip_images: list, minimum, maximum, img_shape=None, off=5,
+                origins=None):
     cropped_img = []
     for i in range(len(dip_images)):
-        # max boundary pixels
-        x_max_padding = int(maximum[i][0])
-        y_max_padding = int(maximum[i][1])
-        # min boudary pixels
-        x_min_padding = int(minimum[i][0])
-        y_min_padding = int(minimum[i][1])
-
-        if x_max_padding+off > img_shape[0] or y_max_padding+off > img_shape[1] or \
-            x_min_padding-off < 0 or y_min_padding-off < 0 :
-            cropped_img.append(dip.Image.At(dip_images[i], 
-                                slice(x_min_padding,x_max_padding), 
-                                slice(y_min_padding,y_max_padding)))
-        else:
-            cropped_img.append(dip.Image.At(dip_images[i], 
-                            slice(x_min_padding-off,x_max_padding+off), 
-                            slice(y_min_padding-off,y_max_padding+off)))
+        origin = origins[i] if origins is not None else (0,0)
+        cropped_img.append(crop_image(dip_images[i], minimum[i], maximum[i],
+                                        img_shape, off, origin))
     return cropped_img
 
+def kuwahara_halo(size):
+    """ Support radius in pixels of dip.Kuwahara with a kernel of the
+        given size: the output of a pixel depends on the windows 
+        centered on every pixel of its kernel.
+    """
+    return int(np.ceil(size)) + 1
 
-def calculate_hog(dip_images: list, orientation = 8, pixels_per_cell=(16,64), rgb = True, visualize=False):
+def coarse_bbox(img, factor=8, channel=2, margin=40):
+    """ Cheap estimate of the embryo bounding box, from the biggest
+        object of the Otsu threshold of a downsampled channel.
+        Input:
+            - img: full resolution diplib image
+            - factor: downsampling factor
+            - channel: channel to threshold, the blue one as in
+                make_grayscale
+            - margin: pixels added around the estimate to cover the
+                details lost by downsampling and smoothing
+        Returns:
+            - minimum, maximum: (x, y) corners of the box in frame
+                coordinates, clipped to the frame
+    """
+    arr = np.asarray(img)
+    if arr.ndim == 3:
+        arr = arr[:,:,channel]
+    sizes = [arr.shape[1], arr.shape[0]]
+    small = dip.Image(np.ascontiguousarray(arr[::factor, ::factor]))
+    _, measurement = measure_image(dip.OtsuThreshold(small), small, 
+                                    ['Size', 'Minimum', 'Maximum'])
+    if measurement.NumberOfObjects() == 0:
+        return [0, 0], [sizes[0]-1, sizes[1]-1]
+    values, columns = measurement_table(measurement)
+    idx = largest_object(values, columns)
+    minimum = values[idx, feature_columns(columns, 'Minimum')]*factor - margin
+    maximum = (values[idx, feature_columns(columns, 'Maximum')]+1)*factor + margin
+    minimum = [max(0, int(x)) for x in minimum]
+    maximum = [min(s-1, int(x)) for x, s in zip(maximum, sizes)]
+    return minimum, maximum
+
+def roi_filter(img, func, minimum, maximum, halo, exact=True):
+    """ Applies func only to the region of interest of img between
+        minimum and maximum (inclusive, (x, y) frame coordinates), 
+        extended by halo pixels so that the result matches 
+        func(img) cropped to the same box.
+        Input:
+            - img: full frame diplib image
+            - func: filter to apply, e.g. grayscale_image
+            - minimum, maximum: corners of the region of interest
+            - halo: support radius of func, e.g. kuwahara_halo(10)
+            - exact: diplib accumulates some filters (e.g. Kuwahara)
+                in float32 along the image lines, so the rounding
+                depends on where the lines start. When True the region
+                keeps the full image width and only rows are skipped,
+                giving bit identical results, otherwise columns are
+                cropped as well and results match up to rounding.
+                This only concerns the filtered region: the stages
+                after it still see the region, see make_grayscale_roi
+        Returns:
+            - the filtered region of interest
+    """
+    sizes = img.Sizes()
+    lo = [max(0, int(minimum[i])-halo) for i in range(2)]
+    hi = [min(sizes[i]-1, int(maximum[i])+halo) for i in range(2)]
+    if exact:
+        lo[0], hi[0] = 0, sizes[0]-1
+    region = dip.Image.At(img, slice(lo[0],hi[0]), slice(lo[1],hi[1]))
+    out = func(region)
+    return dip.Image.At(out, 
+                        slice(int(minimum[0])-lo[0], int(maximum[0])-lo[0]),
+                        slice(int(minimum[1])-lo[1], int(maximum[1])-lo[1]))
+
+def grayscale_roi_image(img, factor=8, margin=40, halo=None, exact=True):
+    """ Region of interest first version of grayscale_image: the 
+        Kuwahara filter only runs around the coarse embryo bounding box.
+        Returns:
+            - the grayscale region of interest and its origin (x, y)
+                in the frame
+    """
+    if halo is None:
+        halo = kuwahara_halo(10)
+    minimum, maximum = coarse_bbox(img, factor, margin=margin)
+    gray = roi_filter(img, grayscale_image, minimum, maximum, halo, exact)
+    return gray, minimum
+
+@instrumented()
+def make_grayscale_roi(dip_images: list, factor=8, margin=40, halo=None, 
+                        exact=True, workers=1, chunksize=1, cache=None):
+    """ Region of interest first version of make_grayscale.
+        The regions match make_grayscale cropped to them, but the
+        stages after it only see the region: a histogram based
+        threshold (Otsu, triangle) then differs from the full frame
+        one, so the masks and measurements downstream are an
+        approximation of the full frame pipeline, the embryo areas
+        being typically 5 to 9% smaller (see benchmark --check-roi).
+        Only the full frame histogram gives the full frame threshold,
+        and it needs the Kuwahara filter on the whole frame.
+        Returns:
+            - grays: list of grayscale regions of interest
+            - origins: list with the (x, y) frame position of each region
+    """
+    print("Warning: region of interest segmentation, the masks and "
+            "measurements differ from a full frame run (embryo areas "
+            "typically 5 to 9% smaller)", file=sys.stderr)
+    func = partial(grayscale_roi_image, factor=factor, margin=margin, 
+                    halo=halo, exact=exact)
+    results = parallel_map(func, dip_images, workers=workers, 
+                            chunksize=chunksize, cache=cache)
+    return [x[0] for x in results], [x[1] for x in results]
 
-    hog_images= []
-    for img in dip_images:
-        _, hog_image = hog(img, orientations= orientation, 
-                            pixels_per_cell=pixels_per_cell,
-                            cells_per_block=(1, 1), visualize=visualize, 
-                            channel_axis=-1 if rgb else None)
-        hog_images.append(dip.Image(hog_image))
 
-    return hog_images
+@instrumented()
+def calculate_hog(dip_images: list, orientation = 8, pixels_per_cell=(16,64), rgb = True, visualize=False,
+                    workers=1, chunksize=1, cache=None):
 
+    func = partial(hog_image, orientation=orientation, 
+                    pixels_per_cell=pixels_per_cell, rgb=rgb, 
+                    visualize=visualize)
+    return parallel_map(func, dip_images, workers=workers, 
+                        chunksize=chunksize, cache=cache)
+
+def hog_image(img, orientation = 8, pixels_per_cell=(16,64), rgb = True, visualize=False):
+    """ Calculates the HOG of a single image
+        Returns:
+            - the HOG visualisation as a diplib image if visualize,
+                otherwise the descriptor (computing the visualisation
+                about doubles the cost)
+    """
+    from skimage.feature import hog
+    result = hog(img, orientations= orientation, 
+                    pixels_per_cell=pixels_per_cell,
+                    cells_per_block=(1, 1), visualize=visualize, 
+                    channel_axis=-1 if rgb else None)
+    if visualize:
+        return dip.Image(result[1])
+    return result
 
+# shape (rows, columns) the embryos are brought to before computing
+# their HOG, a multiple of the default pixels_per_cell
+HOG_SHAPE = (128, 256)
+
+def canonical_image(img, shape=HOG_SHAPE, mode="pad"):
+    """ Brings a cropped image to a fixed shape
+        Input:
+            - img: diplib image or numpy array, scalar or color
+            - shape: (rows, columns) of the result
+            - mode: "pad" centers the image on a black background,
+                shrinking it first (keeping its aspect ratio) if it
+                does not fit, "resize" stretches it to shape
+        Returns:
+            - float32 numpy array of the given shape (and channels)
+    """
+    from skimage.transform import resize
+    arr = np.asarray(img).astype(np.float32)
+    if mode == "resize":
+        scale = (shape[0]/arr.shape[0], shape[1]/arr.shape[1])
+    elif mode == "pad":
+        scale = min(1, shape[0]/arr.shape[0], shape[1]/arr.shape[1])
+        scale = (scale, scale)
+    else:
+        raise ValueError("unknown mode " + str(mode))
+    if scale != (1, 1):
+        new_shape = (min(shape[0], max(1, round(arr.shape[0]*scale[0]))),
+                     min(shape[1], max(1, round(arr.shape[1]*scale[1]))))
+        arr = resize(arr, new_shape + arr.shape[2:], order=1, 
+                        preserve_range=True, anti_aliasing=True)
+    out = np.zeros(tuple(shape) + arr.shape[2:], np.float32)
+    y0 = (shape[0] - arr.shape[0]) // 2
+    x0 = (shape[1] - arr.shape[1]) // 2
+    out[y0:y0+arr.shape[0], x0:x0+arr.shape[1]] = arr
+    return out
+
+def hog_descriptor(img, shape=HOG_SHAPE, orientations=8, 
+                    pixels_per_cell=(16,64), mode="pad"):
+    """ HOG descriptor of a single image brought to a canonical shape
+        Returns:
+            - float32 vector, its length only depending on the shape,
+                the parameters and the channels of img
+    """
+    from skimage.feature import hog
+    arr = canonical_image(img, shape, mode)
+    return hog(arr, orientations=orientations, 
+                pixels_per_cell=pixels_per_cell, cells_per_block=(1, 1),
+                feature_vector=True,
+                channel_axis=-1 if arr.ndim == 3 else None
+                ).astype(np.float32)
+
+def hog_descriptors(*images, shape=HOG_SHAPE, orientations=8, 
+                    pixels_per_cell=(16,64), mode="pad"):
+    """ Concatenated HOG descriptors of several images of an embryo,
+        e.g. the whole embryo and its blue region
+    """
+    return np.concatenate([hog_descriptor(img, shape, orientations, 
+                                            pixels_per_cell, mode) 
+                            for img in images])
+
+@instrumented()
+def hog_features(dip_images: list, blue_images=None, shape=HOG_SHAPE,
+                    orientations=8, pixels_per_cell=(16,64), mode="pad",
+                    workers=1, chunksize=1, cache=None):
+    """ HOG feature matrix of a series of cropped embryos, as input of
+        the classifier
+        Input:
+            - dip_images: python list with the embryo images
+            - blue_images: optional list with the blue region of every
+                embryo, whose descriptor follows the embryo one
+            - shape, mode: canonical shape the images are brought to,
+                see canonical_image
+            - orientations, pixels_per_cell: HOG parameters
+            - workers, chunksize, cache: see parallel_map, with a
+                cache the descriptors are stored per image content
+                and HOG parameters
+        Returns:
+            - contiguous float32 array (n_images, n_features)
+    """
+    func = partial(hog_descriptors, shape=tuple(shape), 
+                    orientations=orientations, 
+                    pixels_per_cell=tuple(pixels_per_cell), mode=mode)
+    series = [dip_images] if blue_images is None else [dip_images, blue_images]
+    rows = parallel_imap(func, *series, workers=workers, 
+                            chunksize=chunksize, cache=cache)
+    features = None
+    for i, row in enumerate(rows):
+        if features is None:
+            features = np.empty((len(dip_images), row.size), np.float32)
+        features[i] = row
+    if features is None:
+        return np.empty((0, 0), np.float32)
+    return features
+
+
+@instrumented()
 def embryo_mask(data_orig: list, data_thresh: list, labeled=False):
     """ Filters the input images to create masks of only 
         the biggest object in the image.
@@ -290,15 +1096,29 @@ def embryo_mask(data_orig: list, data_thresh: list, labeled=False):
         labeled_embr, measurements = measure_elements(data_thresh, 
                                                         data_orig, 
                                                         measures)
-    meas_np = parse_features(measurements)
     new_images = []
     for i in range(len(labeled_embr)):
-        curr_areas = meas_np[i]
-        if len(curr_areas) > 1:
-            max_area = curr_areas.max()
-            new_img = dip.SmallObjectsRemove(data_thresh[i], int(max_area-1))
-            new_images.append(new_img)
-        else: 
-            new_images.append(data_thresh[i])
-
-    return new_images
\ No newline at end of file
+        new_images.append(_keep_largest(data_thresh[i], measurements[i]))
+
+    return new_images
+
+def largest_object_mask(orig, thresh):
+    """ Single image version of embryo_mask.
+        Input:
+            - orig: original image used for the measurements
+            - thresh: thresholded boolean image (mask)
+        Returns:
+            - image with only the biggest element
+    """
+    _, measurement = measure_image(thresh, orig, ['Size'])
+    return _keep_largest(thresh, measurement)
+
+def _keep_largest(thresh, measurement):
+    """ Removes every object of thresh smaller than the biggest one
+    """
+    if measurement.NumberOfObjects() > 1:
+        values, columns = measurement_table(measurement)
+        max_area = values[largest_object(values, columns), 
+                            columns.index('Size')]
+        return dip.SmallObjectsRemove(thresh, int(max_area-1))
+    return thresh
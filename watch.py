@@ -0,0 +1,249 @@
+import os
+import sys
+import time
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from natsort import natsorted
+from utilities import *
+from feature_store import (FeatureStore, file_digest, named_features,
+                            stale_keys)
+from generate_images import process_outputs
+
+try:
+    # filesystem events, to notice new files without waiting for the
+    # next poll
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+
+def is_image_file(filename):
+    """ Same filter as iter_dip_images: numbered tif files
+    """
+    return ".tif" in filename and filename[-5] in "0123456789"
+
+class DirectoryWatcher:
+    """ Reports the image files that appear or change in a directory,
+        once they are completely written: a file is ready when its size
+        and modification time did not change for settle seconds.
+        The directory is scanned every interval seconds; when watchdog
+        is installed, filesystem events trigger a scan right away.
+
+        Params:
+            - directory: directory to watch
+            - settle: seconds a file must stay unchanged
+            - interval: seconds between two scans
+            - known: paths to ignore until they change, e.g. the
+                files already processed
+    """
+
+    def __init__(self, directory, settle=1.0, interval=0.5, known=()):
+        self.directory = directory
+        self.settle = settle
+        self.interval = interval
+        self._seen = {}
+        self._done = {path: self._stat(path) for path in known}
+        self._wake = threading.Event()
+        self._observer = None
+        if Observer is not None:
+            handler = FileSystemEventHandler()
+            handler.on_any_event = lambda event: self._wake.set()
+            self._observer = Observer()
+            self._observer.schedule(handler, directory)
+            self._observer.start()
+
+    def poll(self):
+        """ Scans the directory once
+            Returns:
+                - paths of the files that became ready, natsorted
+        """
+        now = time.monotonic()
+        ready = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file() or not is_image_file(entry.name):
+                continue
+            stat = entry.stat()
+            state = (stat.st_size, stat.st_mtime_ns)
+            if self._done.get(entry.path) == state:
+                continue
+            if self._seen.get(entry.path, (None, 0))[0] != state:
+                # new or still being written
+                self._seen[entry.path] = (state, now)
+            elif now - self._seen[entry.path][1] >= self.settle:
+                del self._seen[entry.path]
+                self._done[entry.path] = state
+                ready.append(entry.path)
+        return natsorted(ready)
+
+    def wait(self, timeout=None):
+        """ Sleeps until the next scan is due or an event arrives
+        """
+        if timeout is None:
+            timeout = self.interval
+        if self._seen:
+            # files are settling, come back when the first one is due
+            first = min(t for _, t in self._seen.values())
+            timeout = min(timeout, max(0.05, first + self.settle -
+                                            time.monotonic()))
+        self._wake.wait(timeout)
+        self._wake.clear()
+
+    def close(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    @staticmethod
+    def _stat(path):
+        stat = os.stat(path)
+        return (stat.st_size, stat.st_mtime_ns)
+
+
+def watch(images_dir='data/', store_dir="features", workers=1, settle=1.0,
+            interval=0.5, output_dir=None, max_images=None):
+    """ Processes the images landing in images_dir as they arrive,
+        adding their features to the feature store (and, optionally,
+        saving the generate_images outputs) without touching the
+        images already processed, unless the new images change their
+        position in the series enough to change their threshold method.
+        Input:
+            - images_dir: watched directory
+            - store_dir: directory of the FeatureStore
+            - workers: processes computing the features
+            - settle, interval: see DirectoryWatcher
+            - output_dir: if set, the transformed images of every new
+                image are saved there as by generate_images --stream
+            - max_images: stop after that many images were added to
+                the store, runs until interrupted if None
+        Returns:
+            - number of images added to the store, the failed ones
+                being reported on stderr
+    """
+    if images_dir[-1] != "/":
+        images_dir += "/"
+    store = FeatureStore(store_dir)
+    names = _series(images_dir)
+    # content hash of every file in the store, by path
+    digests = {images_dir+name: file_digest(images_dir+name)
+                for name in names}
+    stale = {names[i] for i in stale_keys(store,
+                [digests[images_dir+name] for name in names],
+                range(len(names)))}
+    known = [images_dir+name for name in names if name not in stale]
+    digests = {path: digests[path] for path in known}
+    watcher = DirectoryWatcher(images_dir, settle, interval, known)
+    pending = {}
+    processed = failed = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        try:
+            while max_images is None or processed < max_images or pending:
+                if max_images is None or processed + len(pending) < max_images:
+                    ready = watcher.poll()
+                    for path in ready:
+                        _submit(pool, pending, path, images_dir, output_dir,
+                                digests)
+                    if ready:
+                        for path in _moved(store, images_dir, digests,
+                                            pending):
+                            _submit(pool, pending, path, images_dir,
+                                    output_dir, digests)
+                if not pending:
+                    watcher.wait()
+                    continue
+                done, _ = wait(pending, timeout=interval,
+                                return_when=FIRST_COMPLETED)
+                if done:
+                    added, errors = _collect(store, pending, done, output_dir)
+                    processed += added
+                    failed += errors
+        except KeyboardInterrupt:
+            print("Stopping, waiting for %d images" % len(pending))
+            done, _ = wait(pending)
+            added, errors = _collect(store, pending, done, output_dir)
+            processed += added
+            failed += errors
+        finally:
+            watcher.close()
+    if failed:
+        print("%d images failed, %d added" % (failed, processed),
+                file=sys.stderr)
+    return processed
+
+def _series(images_dir):
+    return natsorted([x for x in os.listdir(images_dir) if is_image_file(x)])
+
+def _submit(pool, pending, path, images_dir, output_dir, digests):
+    name = os.path.basename(path)
+    # position in the series, chooses the threshold method
+    index = _series(images_dir).index(name)
+    digests[path] = file_digest(path)
+    pending[pool.submit(_process, path, index, output_dir)] = \
+        (path, digests[path], time.time())
+
+def _moved(store, images_dir, digests, pending):
+    """ Stored images whose threshold method changed with their
+        position in the series
+    """
+    busy = {path for path, _, _ in pending.values()}
+    paths = [images_dir+name for name in _series(images_dir)]
+    indices = {path: i for i, path in enumerate(paths)}
+    paths = [path for path in paths if path in digests and path not in busy
+                and digests[path] in store]
+    keys = [digests[path] for path in paths]
+    return [paths[i] for i in stale_keys(store, keys,
+                                        [indices[path] for path in paths])]
+
+def _process(path, index, output_dir):
+    features = named_features(path, index)
+    if output_dir is not None:
+        orig = dip.ImageReadTIFF(path)
+        for directory, name_temp, img in process_outputs(orig, index):
+            save_image(img, output_dir+directory, name_temp, index)
+    return features
+
+def _collect(store, pending, done, output_dir):
+    """ Adds the features of the done images to the store
+        Returns:
+            - number of images added and number of images that failed
+    """
+    keys, names, rows = [], [], []
+    for future in done:
+        path, key, start = pending.pop(future)
+        try:
+            rows.append(future.result())
+        except Exception as e:
+            print("Failed to process %s: %s" % (path, e), file=sys.stderr)
+            continue
+        keys.append(key)
+        names.append(os.path.basename(path))
+        print("Added %s, %.1fs after it was ready" % (names[-1],
+                                                    time.time() - start))
+    if rows:
+        columns = {name: [row[name] for row in rows] for name in rows[0]}
+        store.upsert(keys, columns, names)
+    return len(rows), len(done) - len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Watches a directory and "
+                                    "processes the new images as they land")
+    parser.add_argument("images_dir", nargs="?", default="data/")
+    parser.add_argument("--store", default="features",
+                        help="directory of the feature store")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, 0 for all cores")
+    parser.add_argument("--settle", type=float, default=1.0,
+                        help="seconds a file must stay unchanged before "
+                            "being processed")
+    parser.add_argument("--interval", type=float, default=0.5,
+                        help="seconds between two scans of the directory")
+    parser.add_argument("--output-dir", default=None,
+                        help="also save the transformed images there")
+    args = parser.parse_args()
+    output_dir = args.output_dir
+    if output_dir is not None and output_dir[-1] != "/":
+        output_dir += "/"
+    watch(args.images_dir, args.store, args.workers or None, args.settle,
+            args.interval, output_dir)